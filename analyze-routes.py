@@ -0,0 +1,141 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+# The app's settings need an email user, but the analysis never sends email.
+# Its logging would end up in the results on stdout.
+os.environ.setdefault("EMAIL_USER", "")
+os.environ.setdefault("APP_LOG_LEVEL", "0")
+os.environ.setdefault("LIB_LOG_LEVEL", "0")
+
+from routes18xxweb import calculation, gamestate, routesearch
+
+# How many game states can be waiting on their results, per process. Enough to
+# keep every process busy while an earlier, slower one holds up the output.
+PENDING_PER_PROCESS = 4
+
+# Finds the best routes for each of the state's railroads in turn, sharing one
+# parsed game state, like a calculate all job.
+def _calculate_all(game_name, railroads_state_rows, private_companies_rows, board_state_rows):
+    game, board_state, railroad_dict = calculation.load_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows)
+
+    results = {}
+    for railroad_name in calculation.get_operating_railroads(railroad_dict):
+        try:
+            routes = routesearch.find_best_routes(game, board_state, railroad_dict, railroad_dict[railroad_name], 1)
+            results[railroad_name] = {"routes": calculation.routes_to_json(routes)}
+        except Exception as exc:
+            results[railroad_name] = {"error": {"message": str(exc)}}
+    return {"railroads": results}
+
+# Runs in the pool. Returns the result line for the input line, which has the
+# same result a calculate (or calculate all, without a railroad name) job
+# stores, or the error it failed with.
+def _analyze(index, line, default_time_budget):
+    result = {"index": index}
+    try:
+        case = json.loads(line)
+        result.update({key: case[key] for key in ("id", "game", "railroad-name") if key in case})
+        missing = [key for key in ("game", "state") if key not in case]
+        if missing:
+            raise ValueError(f"Game state missing {', '.join(missing)}")
+
+        state = case["state"]
+        railroads_state_rows = gamestate.railroads_state_rows(state)
+        if case.get("railroad-name"):
+            # Each game state gets one process, so its search stays in it.
+            routes, is_optimal = calculation.calculate(case["game"], railroads_state_rows, state["private-companies"], state["board"],
+                    case["railroad-name"], case.get("time-budget", default_time_budget), processes=1)
+            result.update({"routes": calculation.routes_to_json(routes), "optimal": is_optimal})
+        else:
+            result.update(_calculate_all(case["game"], railroads_state_rows, state["private-companies"], state["board"]))
+    except Exception as exc:
+        result["error"] = {"message": str(exc)}
+    return result
+
+# Returns the indexes of the input lines already in the output, cutting off
+# any line left half-written when the last run stopped.
+def _read_checkpoint(output_path):
+    if not os.path.exists(output_path):
+        return set()
+
+    done = set()
+    with open(output_path, "rb+") as output_file:
+        complete_length = 0
+        for line in output_file:
+            if not line.endswith(b"\n"):
+                break
+            done.add(json.loads(line)["index"])
+            complete_length += len(line)
+        output_file.truncate(complete_length)
+    return done
+
+def _read_cases(input_file, done):
+    for index, line in enumerate(input_file):
+        if line.strip() and index not in done:
+            yield index, line
+
+# Yields each case's result as it finishes, or in input order if ordered.
+# Only a few cases per process are read ahead, so the input can be as long as
+# it likes.
+def analyze(cases, processes, default_time_budget, ordered):
+    max_pending = processes * PENDING_PER_PROCESS
+    pending = collections.deque()
+    cases = iter(cases)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork")) as executor:
+        while True:
+            for index, line in cases:
+                pending.append(executor.submit(_analyze, index, line, default_time_budget))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the best routes for game states read as JSON lines, each with the game, its state and, "
+            "optionally, a railroad name (without one, every railroad's routes are found) and an id. Each result is written as a JSON line.")
+    parser.add_argument("input", nargs="?", help="the file to read game states from (default: stdin)")
+    parser.add_argument("--output", help="the file to write results to (default: stdout). If it already has results, the game states they're for "
+            "are skipped and the rest are added to it, so a stopped run can be resumed.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="how many game states to analyze at once (default: %(default)s)")
+    parser.add_argument("--time-budget", type=float,
+            help="stop searching for a railroad's routes after this many seconds, unless the game state gives its own time-budget")
+    parser.add_argument("--unordered", action="store_true", help="write results as they finish, rather than in input order")
+    args = parser.parse_args()
+
+    done = _read_checkpoint(args.output) if args.output else set()
+
+    start_time = time.perf_counter()
+    counts = collections.Counter()
+    input_file = open(args.input) if args.input else sys.stdin
+    output_file = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for result in analyze(_read_cases(input_file, done), max(args.processes, 1), args.time_budget, not args.unordered):
+            output_file.write(json.dumps(result) + "\n")
+            # Every written line is a checkpoint.
+            output_file.flush()
+            counts["error" if "error" in result else "done"] += 1
+    finally:
+        if args.input:
+            input_file.close()
+        if args.output:
+            output_file.close()
+
+    print(f"Analyzed {sum(counts.values())} game states ({counts['error']} failed, {len(done)} already done) in "
+          f"{time.perf_counter() - start_time:.1f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
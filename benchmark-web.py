@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import time
+import urllib.request
+import uuid
+
+# The app's settings need an email user, but the benchmark never sends email.
+# Logging every poll would measure the logging.
+os.environ.setdefault("EMAIL_USER", "")
+os.environ.setdefault("APP_LOG_LEVEL", "0")
+
+from rq.job import Job, JobStatus
+
+from routes18xxweb.calculator import redis_conn
+
+# The gunicorn arguments for each way of serving the app. "sync" is how the
+# Procfile runs it.
+MODES = {
+    "sync": ["--worker-class", "gthread", "--threads", "16", "routes18xxweb.routes18xxweb:app"],
+    "async": ["--worker-class", "uvicorn.workers.UvicornWorker", "routes18xxweb.asgi:app"]
+}
+
+SERVER_START_TIMEOUT = 120
+
+# A job that's stuck in progress, so every poll reads it from Redis, the same
+# as polling a running calculation.
+def _create_job():
+    job = Job.create("os.getpid", id=f"benchmark-{uuid.uuid4()}", connection=redis_conn)
+    job.meta = {"routes": [["6", ["B18", "B16", "C15"], 120, [["Sarnia", 70], ["Port Huron", 50]]]], "progress": 0.5}
+    job.save()
+    job.set_status(JobStatus.STARTED)
+    return job
+
+def _start_server(mode, port, workers):
+    command = ["gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers), *MODES[mode]]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The {mode} server exited with {server.returncode}: {' '.join(command)}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.5)
+
+    server.terminate()
+    raise RuntimeError(f"The {mode} server didn't start within {SERVER_START_TIMEOUT}s")
+
+async def _read_headers(reader):
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            return status, headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+async def _read_response(reader):
+    status, headers = await _read_headers(reader)
+    await reader.readexactly(int(headers.get("content-length", 0)))
+    return status, headers.get("connection", "").lower() != "close"
+
+def _request(port, path):
+    return f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n".encode("ascii")
+
+# Requests the path over one keep-alive connection, every interval seconds,
+# until the deadline. Each request's latency goes in latencies. With no
+# interval, it's a client loading pages as fast as it can; with one, it's a
+# browser polling for a result.
+async def _poll(port, path, deadline, latencies, errors, interval=0):
+    request = _request(port, path)
+    writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if not writer:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+            start_time = time.perf_counter()
+            writer.write(request)
+            status, keep_alive = await _read_response(reader)
+            latencies.append(time.perf_counter() - start_time)
+            if status != 200:
+                errors.append(status)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError) as exc:
+            errors.append(exc)
+            keep_alive = False
+
+        if not keep_alive and writer:
+            writer.close()
+            writer = None
+        if interval:
+            await asyncio.sleep(interval)
+    if writer:
+        writer.close()
+
+# Watches the result like the page does: it holds a result stream open,
+# reconnecting whenever the server ends it, until the deadline. Once a stream
+# is refused, it polls the result every second instead.
+async def _stream(port, stream_path, poll_path, deadline, stream_counts, latencies, errors):
+    while time.perf_counter() < deadline:
+        writer = None
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(_request(port, stream_path))
+            status, _ = await _read_headers(reader)
+            if status != 200:
+                stream_counts["refused"] += 1
+                writer.close()
+                await _poll(port, poll_path, deadline, latencies, errors, interval=1)
+                return
+
+            stream_counts["opened"] += 1
+            while await asyncio.wait_for(reader.read(65536), timeout=max(deadline - time.perf_counter(), 0)):
+                pass
+        except asyncio.TimeoutError:
+            pass
+        except (OSError, ValueError, IndexError) as exc:
+            errors.append(exc)
+            await asyncio.sleep(1)
+        finally:
+            if writer:
+                writer.close()
+
+async def _run_pollers(port, path, concurrency, duration):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[_poll(port, path, deadline, latencies, errors) for _ in range(concurrency)])
+    return latencies, errors
+
+# Loads pages while other clients watch a result, over streams when the
+# server takes them.
+async def _run_page_loads(port, page_path, stream_path, poll_path, page_loaders, streams, duration):
+    latencies, errors = [], []
+    stream_counts, poll_latencies = {"opened": 0, "refused": 0}, []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*[_stream(port, stream_path, poll_path, deadline, stream_counts, poll_latencies, errors) for _ in range(streams)],
+            *[_poll(port, page_path, deadline, latencies, errors) for _ in range(page_loaders)])
+    return latencies, errors, stream_counts, poll_latencies
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)]
+
+def _report(mode, latencies, errors, duration):
+    if not latencies:
+        return f"{mode}: no responses ({len(errors)} errors)"
+
+    latencies = sorted(latencies)
+    percentiles = ", ".join(f"p{percent} {_percentile(latencies, percent) * 1000:.1f}ms" for percent in (50, 90, 99))
+    return (f"{mode}: {len(latencies) / duration:.0f} requests/s ({len(latencies)} in {duration:.0f}s), "
+            f"latency mean {statistics.mean(latencies) * 1000:.1f}ms, {percentiles}, max {latencies[-1] * 1000:.1f}ms, {len(errors)} errors")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare how many result polls each way of serving the app can answer, with many clients "
+            "polling a running calculation at once, then how quickly it loads pages while other clients watch the calculation's result "
+            "stream. Each server gets the same number of processes. Needs Redis.")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES), help="the ways of serving the app to compare (default: all)")
+    parser.add_argument("--concurrency", type=int, default=500, help="how many clients poll at once, each over its own connection (default: %(default)s)")
+    parser.add_argument("--streams", type=int, default=200, help="how many clients watch the result stream while pages load (default: %(default)s)")
+    parser.add_argument("--page-loaders", type=int, default=10, help="how many clients load pages at once, while the streams are open "
+            "(default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=10, help="how many seconds to run each test against each server for "
+            "(default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="how many processes each server runs (default: %(default)s)")
+    parser.add_argument("--game", default="1846", help="the game to poll results in (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8765, help="the port to run the servers on (default: %(default)s)")
+    args = parser.parse_args()
+
+    job = _create_job()
+    path = f"/game/{args.game}/calculate/result?jobId={job.id}"
+    stream_path = f"/game/{args.game}/calculate/result/stream?jobId={job.id}"
+    page_path = f"/game/{args.game}/"
+    try:
+        for mode in args.modes:
+            server = _start_server(mode, args.port, args.workers)
+            try:
+                latencies, errors = asyncio.run(_run_pollers(args.port, path, args.concurrency, args.duration))
+                print(_report(f"{mode} polls", latencies, errors, args.duration), flush=True)
+
+                latencies, errors, stream_counts, poll_latencies = asyncio.run(_run_page_loads(args.port, page_path, stream_path, path,
+                        args.page_loaders, args.streams, args.duration))
+                print(_report(f"{mode} page loads with {args.streams} result watchers", latencies, errors, args.duration), flush=True)
+                print(f"{mode} result watchers: {stream_counts['opened']} streams opened, {stream_counts['refused']} refused "
+                        f"and polled instead ({len(poll_latencies)} polls)", flush=True)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        job.delete()
+
+if __name__ == "__main__":
+    main()
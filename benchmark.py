@@ -0,0 +1,143 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+# The app's settings need an email user, but the benchmark never sends email.
+# Its logging would only drown out the results.
+os.environ.setdefault("EMAIL_USER", "")
+os.environ.setdefault("APP_LOG_LEVEL", "0")
+os.environ.setdefault("LIB_LOG_LEVEL", "0")
+
+from routes18xxweb import calculation, gamestate, routesearch
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark-corpus")
+
+STAGES = ("boardstate.load", "railroads.load", "capture_phase", "private_companies.load", "validate", "find_best_routes", "routes_to_json")
+
+# Stages faster than this are too noisy to call a regression.
+MIN_COMPARED_SECONDS = 0.01
+
+def _get_case_paths(case_names):
+    if not case_names:
+        return sorted(glob.glob(os.path.join(CORPUS_DIR, "*.json")))
+    return [os.path.join(CORPUS_DIR, f"{name}.json") for name in case_names]
+
+def _case_name(case_path):
+    return os.path.splitext(os.path.basename(case_path))[0]
+
+# Runs the same stages as a calculation job, timing each one.
+def _run_case(case, processes):
+    state = case["state"]
+    stage_times = {}
+
+    # Otherwise repeats would time copying the board from the cache, rather
+    # than parsing and validating it.
+    calculation.clear_board_state_cache()
+
+    game, board_state, railroad_dict = calculation.load_game_state(case["game"], gamestate.railroads_state_rows(state),
+            state["private-companies"], state["board"], stage_times)
+    railroad = calculation.get_railroad(railroad_dict, case["railroad-name"])
+
+    start_time = time.perf_counter()
+    routes = routesearch.find_best_routes(game, board_state, railroad_dict, railroad, processes)
+    stage_times["find_best_routes"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    calculation.routes_to_json(routes)
+    stage_times["routes_to_json"] = time.perf_counter() - start_time
+
+    return stage_times, routes.value
+
+def run(case_paths, repeat, processes):
+    results = {}
+    for case_path in case_paths:
+        with open(case_path) as case_file:
+            case = json.load(case_file)
+
+        runs = [_run_case(case, processes) for _ in range(repeat)]
+        stages = {}
+        for stage in STAGES:
+            stage_times = [stage_times[stage] for stage_times, _ in runs]
+            stages[stage] = {"median": statistics.median(stage_times), "min": min(stage_times)}
+
+        results[_case_name(case_path)] = {
+            "game": case["game"],
+            "railroad-name": case["railroad-name"],
+            "value": runs[0][1],
+            "total": statistics.median([sum(stage_times.values()) for stage_times, _ in runs]),
+            "stages": stages
+        }
+
+    return {
+        "python": platform.python_version(),
+        "processes": processes,
+        "repeat": repeat,
+        "cases": results
+    }
+
+# Returns a description of each stage that got slower than the baseline by more
+# than the threshold, and each case whose routes changed value.
+def compare(results, baseline, threshold):
+    regressions = []
+    for case_name, case_result in results["cases"].items():
+        baseline_case = baseline["cases"].get(case_name)
+        if not baseline_case:
+            continue
+
+        if case_result["value"] != baseline_case["value"]:
+            regressions.append(f"{case_name}: routes worth {case_result['value']}, baseline {baseline_case['value']}")
+
+        for stage, stage_result in case_result["stages"].items():
+            baseline_time = baseline_case["stages"].get(stage, {}).get("median")
+            if baseline_time is not None and stage_result["median"] > max(baseline_time, MIN_COMPARED_SECONDS) * threshold:
+                regressions.append(f"{case_name}: {stage} took {stage_result['median']:.3f}s, baseline {baseline_time:.3f}s")
+    return regressions
+
+def _print_results(results, baseline):
+    for case_name, case_result in results["cases"].items():
+        baseline_case = (baseline or {}).get("cases", {}).get(case_name)
+        print(f"{case_name} ({case_result['railroad-name']}, {case_result['value']}): {case_result['total']:.3f}s")
+        for stage, stage_result in case_result["stages"].items():
+            line = f"    {stage:<24}{stage_result['median'] * 1000:>10.1f}ms"
+            if baseline_case and stage in baseline_case["stages"]:
+                line += f"{baseline_case['stages'][stage]['median'] * 1000:>10.1f}ms baseline"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of calculating routes for the game states in benchmark-corpus.")
+    parser.add_argument("cases", nargs="*", help="the names of the cases to run (default: all of them)")
+    parser.add_argument("--repeat", type=int, default=3, help="how many times to run each case (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1, help="how many processes the route search uses (default: %(default)s)")
+    parser.add_argument("--output", help="write the results as JSON to this file, e.g. to save a baseline")
+    parser.add_argument("--baseline", help="compare against results saved with --output")
+    parser.add_argument("--threshold", type=float, default=1.25,
+            help="how many times slower than the baseline a stage can get before it's a regression (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = run(_get_case_paths(args.cases), args.repeat, args.processes)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    _print_results(results, baseline)
+
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
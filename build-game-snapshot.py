@@ -0,0 +1,22 @@
+import argparse
+import os
+import time
+
+# The app's settings need an email user, but building the snapshot never sends
+# email.
+os.environ.setdefault("EMAIL_USER", "")
+os.environ.setdefault("APP_LOG_LEVEL", "0")
+
+from routes18xxweb import games
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the parsed data of every supported game to a snapshot the app loads at startup.")
+    parser.add_argument("--output", default=games.SNAPSHOT_PATH, help="where to write the snapshot (default: %(default)s)")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    games.write_snapshot(args.output)
+    print(f"Wrote {args.output} in {time.perf_counter() - start_time:.2f}s ({os.path.getsize(args.output) // 1024}KB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import glob
+import hashlib
+import io
+import json
+import math
+import os
+
+# The app's settings need an email user, but building the atlases never sends
+# email.
+os.environ.setdefault("EMAIL_USER", "")
+os.environ.setdefault("APP_LOG_LEVEL", "0")
+
+from PIL import Image, ImageChops, ImageStat
+
+from routes18xxweb.games import get_game, get_supported_game_info
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes18xxweb", "static")
+TILES_DIR = os.path.join(STATIC_DIR, "images", "tiles")
+ATLAS_DIR = os.path.join(STATIC_DIR, "images", "tile-atlases")
+
+# Each tile's base rotation: how many degrees clockwise its image has to turn
+# before orientation 0 (another 150 degrees) lines up with the board. The
+# images weren't all drawn the same way around.
+TILE_ROTATIONS_PATH = os.path.join(TILES_DIR, "rotations.json")
+ORIENTATIONS = 6
+
+# Space between sprites, so scaling one down doesn't pull in its neighbors'
+# edges.
+PADDING = 2
+
+def _get_tile_images(game_name):
+    tile_images = {}
+    for tile_id in get_game(game_name).tiles:
+        tile_name = tile_id.zfill(3)
+        tile_images[tile_name] = Image.open(os.path.join(TILES_DIR, f"{tile_name}.png")).convert("RGBA")
+    return dict(sorted(tile_images.items()))
+
+# Packs the tiles into a square-ish grid. They're all the same size.
+def _pack(tile_images):
+    width, height = next(iter(tile_images.values())).size
+    columns = math.ceil(math.sqrt(len(tile_images)))
+    rows = math.ceil(len(tile_images) / columns)
+
+    atlas = Image.new("RGBA", (columns * (width + PADDING), rows * (height + PADDING)))
+    sprites = {}
+    for index, (tile_name, tile_image) in enumerate(tile_images.items()):
+        x, y = (index % columns) * (width + PADDING), (index // columns) * (height + PADDING)
+        atlas.paste(tile_image, (x, y))
+        sprites[tile_name] = {"x": x, "y": y, "width": width, "height": height}
+    return atlas, sprites
+
+def _on_white(image):
+    background = Image.new("RGBA", image.size, "white")
+    background.alpha_composite(image)
+    return background.convert("RGB")
+
+# Turns the tile clockwise about its center, like the page does, and cuts out
+# an image of the given size around the center, shifted by the offset.
+def _render(tile_image, degrees, size, offset):
+    rotated = tile_image.rotate(-degrees, expand=True, resample=Image.BICUBIC)
+    left = (rotated.width - size[0]) // 2 + offset[0]
+    top = (rotated.height - size[1]) // 2 + offset[1]
+    return _on_white(rotated.crop((left, top, left + size[0], top + size[1])))
+
+def _difference(image1, image2):
+    return sum(ImageStat.Stat(ImageChops.difference(image1, image2)).mean)
+
+# Returns the base rotation that best turns the tile into the pre-rotated
+# image for the orientation. The pre-rotated images can be a pixel off center.
+def _match_rotation(tile_image, reference, orientation):
+    def difference(base_rotation):
+        offsets = [(x, y) for x in (-1, 0, 1) for y in (-1, 0, 1)]
+        return min(_difference(_render(tile_image, base_rotation + 150 + 60 * orientation, reference.size, offset), reference) for offset in offsets)
+    return min(range(0, 360, 60), key=difference)
+
+# Works out each tile's base rotation from pre-rotated images of it, named
+# {tile}-{orientation}.png, like the ones the page used to load.
+def find_rotations(reference_dir):
+    rotations = {}
+    for tile_path in sorted(glob.glob(os.path.join(TILES_DIR, "[0-9][0-9][0-9].png"))):
+        tile_name = os.path.splitext(os.path.basename(tile_path))[0]
+        reference_paths = [os.path.join(reference_dir, f"{tile_name}-{orientation}.png") for orientation in range(ORIENTATIONS)]
+        if not all(os.path.exists(reference_path) for reference_path in reference_paths):
+            print(f"{tile_name}: no pre-rotated images, skipping")
+            continue
+
+        tile_image = Image.open(tile_path).convert("RGBA")
+        matches = [_match_rotation(tile_image, _on_white(Image.open(reference_path).convert("RGBA")), orientation)
+                   for orientation, reference_path in enumerate(reference_paths)]
+        if len(set(matches)) != 1:
+            raise ValueError(f"Tile {tile_name}'s pre-rotated images don't agree on its rotation: {matches}")
+        rotations[tile_name] = matches[0]
+    return rotations
+
+def _load_rotations():
+    with open(TILE_ROTATIONS_PATH) as rotations_file:
+        return json.load(rotations_file)
+
+def _encode(atlas, image_format):
+    atlas_file = io.BytesIO()
+    if image_format == "webp":
+        atlas.save(atlas_file, "webp", lossless=True, quality=100, method=6)
+    else:
+        atlas.save(atlas_file, "png", optimize=True)
+    return atlas_file.getvalue()
+
+def build(game_name, rotations):
+    atlas, sprites = _pack(_get_tile_images(game_name))
+    for tile_name, sprite in sprites.items():
+        if tile_name not in rotations:
+            raise ValueError(f"Tile {tile_name} has no rotation in {TILE_ROTATIONS_PATH}")
+        sprite["rotation"] = rotations[tile_name]
+    encoded_atlases = {image_format: _encode(atlas, image_format) for image_format in ("webp", "png")}
+
+    # The file names change with the content, so they can be cached forever.
+    atlas_hash = hashlib.sha256(encoded_atlases["png"]).hexdigest()[:12]
+    for old_atlas_path in glob.glob(os.path.join(ATLAS_DIR, f"{game_name}-*")):
+        os.remove(old_atlas_path)
+
+    index = {"sprites": sprites}
+    for image_format, encoded_atlas in encoded_atlases.items():
+        filename = f"{game_name}-{atlas_hash}.{image_format}"
+        with open(os.path.join(ATLAS_DIR, filename), "wb") as atlas_file:
+            atlas_file.write(encoded_atlas)
+        index[image_format] = filename
+
+    with open(os.path.join(ATLAS_DIR, f"{game_name}.json"), "w") as index_file:
+        json.dump(index, index_file, indent=4)
+
+    return index, {image_format: len(encoded_atlas) for image_format, encoded_atlas in encoded_atlases.items()}
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack each game's tile images into one atlas, plus an index of where each tile is.")
+    parser.add_argument("games", nargs="*", help="the games to build atlases for (default: all of them)")
+    parser.add_argument("--references", metavar="DIR", help="first work out each tile's rotation from the pre-rotated images in DIR, "
+            "and save them")
+    args = parser.parse_args()
+
+    if args.references:
+        rotations = dict(_load_rotations() if os.path.exists(TILE_ROTATIONS_PATH) else {}, **find_rotations(args.references))
+        with open(TILE_ROTATIONS_PATH, "w") as rotations_file:
+            json.dump(dict(sorted(rotations.items())), rotations_file, indent=4)
+        print(f"Saved {len(rotations)} tile rotations ({sum(1 for rotation in rotations.values() if rotation)} turned)")
+
+    rotations = _load_rotations()
+    os.makedirs(ATLAS_DIR, exist_ok=True)
+    for game_name in args.games or get_supported_game_info():
+        index, sizes = build(game_name, rotations)
+        print(f"{game_name}: {len(index['sprites'])} tiles, " + ", ".join(f"{index[image_format]} ({size // 1024}KB)" for image_format, size in sizes.items()))
+
+if __name__ == "__main__":
+    main()
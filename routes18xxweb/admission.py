@@ -0,0 +1,91 @@
+import os
+import time
+
+from rq import Queue
+from rq.job import Job, JobStatus
+
+from routes18xxweb import metrics
+from routes18xxweb.calculator import listen, redis_conn
+
+REDIS_KEY_PREFIX = "admission"
+
+# How many calculations one browser session, and one IP address (which can be
+# shared by many sessions), can have queued or running at once.
+MAX_CLIENT_JOBS = int(os.getenv("MAX_CLIENT_JOBS", 2))
+MAX_IP_JOBS = int(os.getenv("MAX_IP_JOBS", 6))
+
+# Past this many queued calculations, new ones are turned away rather than
+# waiting behind them.
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", 50))
+
+# The seconds a rejected client is told to wait before trying again.
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 10))
+
+# A client's job list expires once it hasn't submitted anything for this long.
+CLIENT_JOBS_TTL = 60 * 60
+
+IN_FLIGHT_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+class Rejected(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = RETRY_AFTER
+
+def _client_jobs_key(client_id):
+    return f"{REDIS_KEY_PREFIX}-client-{client_id}"
+
+def _ip_jobs_key(ip):
+    return f"{REDIS_KEY_PREFIX}-ip-{ip}"
+
+# Returns the in-flight jobs in the list, oldest first, dropping the rest from it.
+def _in_flight_jobs(key):
+    job_ids = [job_id.decode("utf-8") for job_id in redis_conn.zrange(key, 0, -1)]
+    if not job_ids:
+        return []
+
+    jobs = Job.fetch_many(job_ids, connection=redis_conn)
+    in_flight_jobs = [job for job in jobs if job and job.get_status(refresh=False) in IN_FLIGHT_STATUSES]
+
+    in_flight_ids = {job.id for job in in_flight_jobs}
+    done_ids = [job_id for job_id in job_ids if job_id not in in_flight_ids]
+    if done_ids:
+        redis_conn.zrem(key, *done_ids)
+    return in_flight_jobs
+
+# The client's jobs that are still waiting for a worker. A new submission
+# replaces them.
+def get_queued_jobs(client_id):
+    return [job for job in _in_flight_jobs(_client_jobs_key(client_id)) if job.get_status(refresh=False) == JobStatus.QUEUED]
+
+def _queued_job_count():
+    return sum(Queue(name, connection=redis_conn).count for name in listen)
+
+# Raises Rejected if the client can't start another calculation right now.
+def check(client_id, ip):
+    if len(_in_flight_jobs(_client_jobs_key(client_id))) >= MAX_CLIENT_JOBS:
+        metrics.increment("admission-rejected-client")
+        raise Rejected("Too many calculations in progress. Wait for one to finish, or cancel it.", 429)
+
+    if len(_in_flight_jobs(_ip_jobs_key(ip))) >= MAX_IP_JOBS:
+        metrics.increment("admission-rejected-ip")
+        raise Rejected("Too many calculations in progress from this address.", 429)
+
+    if _queued_job_count() >= MAX_QUEUED_JOBS:
+        metrics.increment("admission-rejected-busy")
+        raise Rejected("The server is busy. Please try again shortly.", 503)
+
+def track(client_id, ip, job_id):
+    with redis_conn.pipeline() as pipe:
+        for key in (_client_jobs_key(client_id), _ip_jobs_key(ip)):
+            pipe.zadd(key, {job_id: time.time()})
+            pipe.expire(key, CLIENT_JOBS_TTL)
+        pipe.execute()
+
+# The client no longer waits on the job, so it stops counting toward the
+# client's limits, even if others keep it running.
+def untrack(client_id, ip, job_id):
+    with redis_conn.pipeline() as pipe:
+        pipe.zrem(_client_jobs_key(client_id), job_id)
+        pipe.zrem(_ip_jobs_key(ip), job_id)
+        pipe.execute()
@@ -0,0 +1,428 @@
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+import uuid
+
+import redis.asyncio
+from flask import g, jsonify, redirect, request, session, url_for
+from rq.job import Job, JobStatus
+from werkzeug.exceptions import HTTPException
+
+from routes18xxweb import metrics, resultcache
+from routes18xxweb.calculator import JOB_CANCEL_TTL, job_cancel_key, job_events_channel, redis_conn, redis_url
+from routes18xxweb.games import get_supported_game_info
+from routes18xxweb.routes18xxweb import app as flask_app, csrf
+from routes18xxweb.views import GAME_APP_ROOT, LOG, PAYLOAD_LOG
+from routes18xxweb.views import calculate, migrate
+
+# Serves the app over ASGI (e.g. with uvicorn's gunicorn worker). The endpoints
+# that only wait on redis, like result polls and streams, are answered on the
+# event loop, so one process can hold thousands of open requests. Everything
+# else goes to the Flask app, run on a pool of WSGI_THREADS threads.
+
+# Connections in the pool are shared by every request the process is handling.
+# Once they're all in use, requests wait for one to be freed.
+ASYNC_REDIS_MAX_CONNECTIONS = int(os.getenv("ASYNC_REDIS_MAX_CONNECTIONS", 20))
+
+# The same number of threads the Procfile gives gunicorn's gthread workers.
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", 16))
+
+_REDIS = {}
+
+# Every open result stream in the process shares one pubsub connection, rather
+# than taking its own from the pool. Channel -> the queues of the streams
+# waiting on it.
+_JOB_EVENTS = {"pubsub": None, "reader": None, "queues": {}}
+
+# The pool belongs to the event loop, so it's created once the loop is running.
+def _get_redis():
+    if "client" not in _REDIS:
+        pool = redis.asyncio.BlockingConnectionPool.from_url(redis_url, max_connections=ASYNC_REDIS_MAX_CONNECTIONS)
+        _REDIS["client"] = redis.asyncio.Redis(connection_pool=pool)
+    return _REDIS["client"]
+
+async def _close_redis():
+    if _JOB_EVENTS["reader"]:
+        _JOB_EVENTS["reader"].cancel()
+    if _JOB_EVENTS["pubsub"]:
+        await _JOB_EVENTS["pubsub"].close()
+    _JOB_EVENTS.update(pubsub=None, reader=None)
+
+    client = _REDIS.pop("client", None)
+    if client:
+        await client.close()
+        await client.connection_pool.disconnect()
+
+# Passes each job event on to the streams waiting on the job. After a dropped
+# connection, the pubsub reconnects and subscribes to its channels again.
+async def _read_job_events(pubsub):
+    while True:
+        try:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+        except redis.ConnectionError as exc:
+            LOG.warning("Lost the connection for job events: %s", exc)
+            await asyncio.sleep(1)
+            continue
+
+        if message:
+            for queue in _JOB_EVENTS["queues"].get(message["channel"].decode("utf-8"), ()):
+                queue.put_nowait(message["data"])
+
+async def _subscribe_job_events(job_id):
+    channel = job_events_channel(job_id)
+    queue = asyncio.Queue()
+    if channel not in _JOB_EVENTS["queues"]:
+        _JOB_EVENTS["queues"][channel] = set()
+        if not _JOB_EVENTS["pubsub"]:
+            _JOB_EVENTS["pubsub"] = _get_redis().pubsub()
+        await _JOB_EVENTS["pubsub"].subscribe(channel)
+        # The pubsub only has a connection to read from once it's subscribed.
+        if not _JOB_EVENTS["reader"]:
+            _JOB_EVENTS["reader"] = asyncio.create_task(_read_job_events(_JOB_EVENTS["pubsub"]))
+    _JOB_EVENTS["queues"][channel].add(queue)
+    return queue
+
+async def _unsubscribe_job_events(job_id, queue):
+    channel = job_events_channel(job_id)
+    _JOB_EVENTS["queues"][channel].discard(queue)
+    if not _JOB_EVENTS["queues"][channel]:
+        del _JOB_EVENTS["queues"][channel]
+        await _JOB_EVENTS["pubsub"].unsubscribe(channel)
+
+# Jobs are restored the same way rq's Job.fetch does it, but from a hash read
+# with the asyncio client. The job's status is the one it was read with.
+def _restore_job(job_id, raw_job):
+    if not raw_job:
+        return None
+
+    job = Job(job_id, connection=redis_conn)
+    job.restore(raw_job)
+    return job
+
+async def _fetch_job(job_id):
+    if not job_id:
+        return None
+    return _restore_job(job_id, await _get_redis().hgetall(Job.key_for(job_id)))
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+def _get_job_id(scope):
+    return urllib.parse.parse_qs(scope["query_string"].decode("latin-1")).get("jobId", [None])[0]
+
+# The same as the calculate view's _get_result_json, but the JSON is bytes.
+async def _get_result_json(job_id, get_progress):
+    result_json, raw_job = None, None
+    if job_id:
+        # Most polls are for jobs still in progress, so the job is read along
+        # with the result, rather than after it.
+        async with _get_redis().pipeline(transaction=False) as pipe:
+            pipe.get(resultcache.result_key(job_id))
+            pipe.hgetall(Job.key_for(job_id))
+            result_json, raw_job = await pipe.execute()
+
+    if result_json is not None:
+        return result_json, True
+
+    progress_json = get_progress(job_id, _restore_job(job_id, raw_job))
+    return json.dumps(progress_json).encode("utf-8"), "jobId" not in progress_json
+
+# Returns the status, content type and body.
+async def _result_response(scope, get_progress, log_message):
+    result_json, _ = await _get_result_json(_get_job_id(scope), get_progress)
+
+    PAYLOAD_LOG.info(log_message, result_json)
+
+    return 200, "application/json", result_json
+
+async def calculate_result(scope, receive, game_name):
+    return await _result_response(scope, calculate.calculate_progress, "Calculate response: %s")
+
+async def calculate_all_result(scope, receive, game_name):
+    return await _result_response(scope, calculate.calculate_all_progress, "Calculate all railroads response: %s")
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+# The same stream as the calculate view's _stream_result, without holding a
+# thread while it's open.
+async def _stream_result(job_id, receive, get_progress):
+    loop = asyncio.get_running_loop()
+    # Subscribe before checking on the job, so an event published in between
+    # isn't missed.
+    events = await _subscribe_job_events(job_id)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        result_json, is_done = await _get_result_json(job_id, get_progress)
+        yield b"data: " + result_json + b"\n\n"
+
+        deadline = loop.time() + calculate.RESULT_STREAM_TIMEOUT
+        while not is_done and not disconnected.done() and loop.time() < deadline:
+            event = asyncio.ensure_future(events.get())
+            await asyncio.wait((event, disconnected), timeout=min(calculate.RESULT_STREAM_KEEPALIVE, deadline - loop.time()),
+                    return_when=asyncio.FIRST_COMPLETED)
+            if event.done():
+                # Events that arrived together need only one read of the job.
+                while not events.empty():
+                    events.get_nowait()
+                result_json, is_done = await _get_result_json(job_id, get_progress)
+                yield b"data: " + result_json + b"\n\n"
+            else:
+                event.cancel()
+                if not disconnected.done():
+                    yield b": keepalive\n\n"
+    finally:
+        disconnected.cancel()
+        await _unsubscribe_job_events(job_id, events)
+
+RESULT_STREAM_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no"
+}
+
+async def calculate_result_stream(scope, receive, game_name):
+    return 200, RESULT_STREAM_HEADERS, _stream_result(_get_job_id(scope), receive, calculate.calculate_progress)
+
+async def calculate_all_result_stream(scope, receive, game_name):
+    return 200, RESULT_STREAM_HEADERS, _stream_result(_get_job_id(scope), receive, calculate.calculate_all_progress)
+
+def _wsgi_environ(scope, body):
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": scope["server"][0] if scope.get("server") else "localhost",
+        "SERVER_PORT": str(scope["server"][1]) if scope.get("server") else "80",
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        value = value.decode("latin-1")
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+# Runs the Flask parts of a request (its session, CSRF token and URLs) in a
+# request context, without handing the whole request to the WSGI app.
+def _flask_context(scope, body):
+    return flask_app.request_context(_wsgi_environ(scope, body))
+
+def _flask_response(response):
+    flask_app.session_interface.save_session(flask_app, session, response)
+    return response.status_code, response.headers, response.get_data()
+
+async def cancel_calculate_request(scope, receive, game_name):
+    with _flask_context(scope, await _read_body(receive)):
+        try:
+            csrf.protect()
+        except HTTPException as exc:
+            return _flask_response(flask_app.make_response(flask_app.handle_user_exception(exc)))
+
+        job = await _fetch_job(request.form.get("jobId"))
+        if job:
+            await _cancel_job(job, session.get("client-id", ""))
+        return _flask_response(jsonify({}))
+
+# The same as the calculate view's _cancel_job.
+async def _cancel_job(job, client_id):
+    conn = _get_redis()
+    status = job.get_status(refresh=False)
+    if status == JobStatus.FINISHED:
+        return
+
+    async with conn.pipeline(transaction=False) as pipe:
+        pipe.srem(resultcache.waiters_key(job.id), client_id)
+        pipe.scard(resultcache.waiters_key(job.id))
+        _, waiters = await pipe.execute()
+
+    if waiters == 0:
+        async with conn.pipeline(transaction=False) as pipe:
+            pipe.set(job_cancel_key(job.id), 1, ex=JOB_CANCEL_TTL)
+            pipe.publish(job_events_channel(job.id), "cancel")
+            metrics.queue_increment(pipe, "calculate-cancelled-running" if status == JobStatus.STARTED else "calculate-cancelled-queued")
+            await pipe.execute()
+
+        if status != JobStatus.STARTED:
+            # Taking a job off its queue touches rq's registries, so it's left
+            # to rq, in a thread. Most cancelled jobs have already started.
+            await asyncio.to_thread(job.delete)
+
+async def start_migration(scope, receive, game_name):
+    LOG.info("Migration requested")
+
+    migration_data_json = migrate.parse_migration_data(await _read_body(receive))
+    if migration_data_json is None:
+        return 400, "application/json", json.dumps(migrate.MIGRATION_START_ERROR).encode("utf-8")
+
+    redis_id = str(uuid.uuid4())
+    async with _get_redis().pipeline(transaction=False) as pipe:
+        pipe.hset(migrate.migration_key(redis_id), mapping=migration_data_json)
+        pipe.expire(migrate.migration_key(redis_id), migrate.MIGRATION_TTL)
+        await pipe.execute()
+
+    LOG.info("Migration initiated: %s", redis_id)
+
+    return 201, "application/json", json.dumps({"id": redis_id}).encode("utf-8")
+
+async def complete_migration(scope, receive, game_name):
+    LOG.info("Migration continued")
+
+    with _flask_context(scope, await _read_body(receive)):
+        g.game_name = game_name
+
+        id = request.args.get("id")
+        if migrate.is_migration_id(id):
+            LOG.info("Migration continuing for %s", id)
+
+            async with _get_redis().pipeline(transaction=False) as pipe:
+                pipe.hgetall(migrate.migration_key(id))
+                # Once we get the data, we no longer need it, regardless of validity.
+                pipe.delete(migrate.migration_key(id))
+                migration_data, _ = await pipe.execute()
+
+            migration_data = migrate.decode_migration_data(migration_data)
+            if migration_data:
+                migrate.store_migration_data(migration_data)
+
+        return _flask_response(redirect(url_for("game_app.main")))
+
+# (method, path within the game) -> (Flask endpoint, handler)
+ASYNC_ROUTES = {
+    ("GET", "calculate/result"): ("game_app.calculate_result", calculate_result),
+    ("GET", "calculate/all/result"): ("game_app.calculate_all_result", calculate_all_result),
+    ("GET", "calculate/result/stream"): ("game_app.calculate_result_stream", calculate_result_stream),
+    ("GET", "calculate/all/result/stream"): ("game_app.calculate_all_result_stream", calculate_all_result_stream),
+    ("POST", "calculate/cancel"): ("game_app.cancel_calculate_request", cancel_calculate_request),
+    ("POST", "migrate/start"): ("game_app.start_migration", start_migration),
+    ("GET", "migrate/complete"): ("game_app.complete_migration", complete_migration)
+}
+
+GAME_PATH_RE = re.compile(f"^{re.escape(GAME_APP_ROOT)}/([^/]+)/(.+)$")
+
+# Returns the game name, Flask endpoint and handler, or Nones if the Flask app
+# should handle the request, including unsupported games' 404 pages.
+def _match(scope):
+    match = GAME_PATH_RE.match(scope["path"])
+    if match and match.group(1) in get_supported_game_info():
+        return (match.group(1), *ASYNC_ROUTES.get((scope["method"], match.group(2)), (None, None)))
+    return None, None, None
+
+async def _send_response_start(send, status, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+    })
+
+async def _send_response(send, status, headers, body):
+    if isinstance(headers, str):
+        headers = {"Content-Type": headers, "Content-Length": str(len(body))}
+    await _send_response_start(send, status, headers)
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_stream(send, body):
+    try:
+        async for chunk in body:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await body.aclose()
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _close_redis()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+_WSGI_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+# Runs in one of the executor's threads. send is called from the thread, and
+# waits for the event loop to send the message.
+def _call_wsgi_app(environ, send):
+    response_start = {"type": "http.response.start"}
+
+    def start_response(status, headers, exc_info=None):
+        if exc_info and "sent" in response_start:
+            raise exc_info[1].with_traceback(exc_info[2])
+        response_start["status"] = int(status.split(" ", 1)[0])
+        response_start["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    def send_body(body, more_body):
+        if "sent" not in response_start:
+            send(dict(response_start))
+            response_start["sent"] = True
+        send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    response = flask_app(environ, start_response)
+    try:
+        for chunk in response:
+            if chunk:
+                send_body(chunk, True)
+        send_body(b"", False)
+    finally:
+        # Flask runs its response callbacks (e.g. call_on_close) on close.
+        if hasattr(response, "close"):
+            response.close()
+
+async def _run_wsgi_app(scope, receive, send):
+    body = await _read_body(receive)
+    loop = asyncio.get_running_loop()
+
+    def send_from_thread(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    await loop.run_in_executor(_WSGI_EXECUTOR, _call_wsgi_app, _wsgi_environ(scope, body), send_from_thread)
+
+async def _record_request(endpoint, scope, status, start_time):
+    labels = {"endpoint": endpoint, "method": scope["method"], "status": status}
+    async with _get_redis().pipeline(transaction=False) as pipe:
+        metrics.queue_observation(pipe, "http-request-duration-seconds", time.perf_counter() - start_time, labels)
+        await pipe.execute()
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    game_name, endpoint, handler = _match(scope) if scope["type"] == "http" else (None, None, None)
+    if not handler:
+        await _run_wsgi_app(scope, receive, send)
+        return
+
+    start_time = time.perf_counter()
+    status, headers, body = await handler(scope, receive, game_name)
+    if isinstance(body, bytes):
+        await _send_response(send, status, headers, body)
+        await _record_request(endpoint, scope, status, start_time)
+    else:
+        # Like the Flask app, a stream is timed until it starts.
+        await _send_response_start(send, status, headers)
+        await _record_request(endpoint, scope, status, start_time)
+        await _send_stream(send, body)
@@ -0,0 +1,114 @@
+import collections
+
+from routes18xx import boardtile, placedtile
+
+# Everything the board endpoints need that only depends on the static game data.
+#  - tile_coords: coords which can hold a tile.
+#  - cities, split_cities: city coords, sorted.
+#  - orientations: coord -> tile ID -> (orientations, translations), for every
+#    tile of the right type for the space.
+#  - legal_tiles: coord -> tile IDs with at least one legal orientation, in
+#    display order.
+#  - split_city_stations: (coord, tile ID, orientation) -> station coords. The
+#    unimproved board space is keyed with a tile ID and orientation of None.
+BoardIndex = collections.namedtuple("BoardIndex", ["tile_coords", "cities", "split_cities", "orientations", "legal_tiles", "split_city_stations"])
+
+def _is_split_city(space):
+    return isinstance(space, (boardtile.SplitCity, placedtile.SplitCity))
+
+def get_orientations(board, cell, tile):
+    all_paths = {}
+    orientations = []
+    translations = {}
+    for orientation in range(0, 6):
+        try:
+            board._validate_place_tile_neighbors(cell, tile, orientation)
+            board._validate_place_tile_upgrade(board.get_space(cell), cell, tile, orientation)
+        except ValueError:
+            continue
+
+        tile_paths = tuple(sorted((key, tuple(sorted(val))) for key, val in placedtile.PlacedTile.get_paths(cell, tile, orientation).items()))
+        if tile_paths in all_paths:
+            translations[orientation] = all_paths[tile_paths]
+            continue
+
+        orientations.append(orientation)
+        all_paths[tile_paths] = orientation
+
+    return orientations, translations
+
+def get_split_city_stations(split_city_space):
+    split_city_station_coords = set()
+    for branch in split_city_space.capacity.keys():
+        unique_exit_coords = [branch_key for branch_key in branch if len(branch_key) == 1]
+        if unique_exit_coords:
+            # A unique exit coord is a sequence of length 1, so we need to extract it
+            split_city_station_coords.add(str(sorted(unique_exit_coords)[0][0]))
+        else:
+            split_city_station_coords.add(str(sorted(branch)[0]))
+
+    return frozenset(split_city_station_coords)
+
+def _candidate_tiles(game, space):
+    # If the coord is a built-in upgrade level 4 tile
+    if space and space.upgrade_level is None:
+        return []
+
+    candidate_tiles = []
+    for tile in game.tiles.values():
+        if not space:
+            if tile.is_stop:
+                continue
+        elif tile.upgrade_level <= space.upgrade_level:
+            continue
+        elif space.is_city != tile.is_city or space.is_town != tile.is_town or tile.upgrade_attrs not in space.upgrade_attrs:
+            continue
+        candidate_tiles.append(tile)
+    return candidate_tiles
+
+def _get_tile_split_city_stations(cell, tile, space):
+    split_city_stations = {}
+    for orientation in range(0, 6):
+        try:
+            tile_space = placedtile.PlacedTile.place(cell, tile, orientation, space)
+        except ValueError:
+            continue
+
+        if _is_split_city(tile_space):
+            split_city_stations[(str(cell), tile.id, orientation)] = get_split_city_stations(tile_space)
+    return split_city_stations
+
+def build(game, board):
+    tile_coords = []
+    for cell in board.cells:
+        space = board.get_space(cell)
+        if not space or space.is_city or space.upgrade_level is not None:
+            tile_coords.append(str(cell))
+
+    cities = []
+    split_cities = []
+    orientations = {}
+    legal_tiles = {}
+    split_city_stations = {}
+    for cell in sorted(board.cells):
+        coord = str(cell)
+        space = board.get_space(cell)
+
+        if space and space.is_city:
+            cities.append(coord)
+            if _is_split_city(space):
+                split_cities.append(coord)
+                split_city_stations[(coord, None, None)] = get_split_city_stations(space)
+
+        orientations[coord] = {}
+        for tile in _candidate_tiles(game, space):
+            tile_orientations, translations = get_orientations(board, cell, tile)
+            orientations[coord][tile.id] = (tuple(tile_orientations), translations)
+            if tile_orientations and tile.is_city:
+                split_city_stations.update(_get_tile_split_city_stations(cell, tile, space))
+
+        legal_tile_ids = [tile_id for tile_id, (tile_orientations, _) in orientations[coord].items() if tile_orientations]
+        legal_tile_ids.sort(key=lambda tile_id: f"{game.tiles[tile_id].upgrade_level}-{tile_id:0>3}")
+        legal_tiles[coord] = tuple(legal_tile_ids)
+
+    return BoardIndex(tuple(tile_coords), tuple(cities), tuple(split_cities), orientations, legal_tiles, split_city_stations)
@@ -0,0 +1,217 @@
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+from routes18xx import boardstate, railroads
+
+from routes18xxweb import routesearch
+from routes18xxweb.games import count_cache_lookup, get_game
+from routes18xxweb.logger import get_logger
+
+LOG = get_logger("routes18xxweb.calculation")
+
+CALCULATE_ALL_PROCESSES = int(os.getenv("CALCULATE_ALL_PROCESSES", os.cpu_count()))
+
+# The parsed game state shared with the processes calculating each railroad
+# in a batch. They're forked after it's set, so it never needs to be pickled.
+_BATCH_STATE = None
+
+# How many parsed board states a process keeps, most recently used first.
+# Comparing railroads means calculating each of them against the same board,
+# so only the first has to parse it. Work-horses don't outlive their job, so
+# across jobs this only helps with WORKER_MODE=simple (and web processes).
+BOARD_STATE_CACHE_SIZE = int(os.getenv("BOARD_STATE_CACHE_SIZE", 32))
+
+# How many railroads and private companies states each cached board remembers
+# passing validation with, most recently used first. A board that stays
+# popular stays cached, so this keeps it from growing without bound.
+VALIDATED_STATES_PER_BOARD = 8
+
+# Board state key -> {"board": the parsed board, before any railroads are
+# placed on it, "validated": an OrderedDict whose keys are the keys of the
+# rest of the states it's passed validation with}
+_BOARD_STATES = collections.OrderedDict()
+
+# Web processes check game states from several threads at once. Loading one
+# captures its phase on the game object they all share, so they take turns.
+_CHECK_LOCK = threading.Lock()
+
+def _rows_to_dicts(fieldnames, rows):
+    return [dict(zip(fieldnames, row)) for row in rows if any(val for val in row)]
+
+# Records how long the stage took in stage_times, if it's given.
+@contextlib.contextmanager
+def _timed_stage(stage_times, stage):
+    start_time = time.perf_counter()
+    yield
+    if stage_times is not None:
+        stage_times[stage] = time.perf_counter() - start_time
+
+def _state_key(*state):
+    return hashlib.sha256(json.dumps(state).encode("utf-8")).hexdigest()
+
+# Copies the spaces railroads and private companies place stations and tokens
+# on. Everything else on the board never changes once it's parsed, so it's
+# shared with the cached board.
+def _copy_space(space):
+    space_copy = copy.copy(space)
+    for attr in ("_stations", "tokens"):
+        if hasattr(space, attr):
+            setattr(space_copy, attr, list(getattr(space, attr)))
+    if hasattr(space, "branch_to_station"):
+        space_copy.branch_to_station = {branch: list(stations) for branch, stations in space.branch_to_station.items()}
+    return space_copy
+
+def _copy_board(board):
+    board_copy = copy.copy(board)
+    board_copy._placed_tiles = {cell: _copy_space(space) for cell, space in board._placed_tiles.items()}
+    board_copy._board_tiles = {cell: _copy_space(space) for cell, space in board._board_tiles.items()}
+    return board_copy
+
+# Returns a copy of the parsed board state, and the cache entry it came from.
+def _load_board_state(game, board_state_rows):
+    board_state_key = _state_key(game.name, board_state_rows)
+    board_state_entry = _BOARD_STATES.get(board_state_key)
+    count_cache_lookup("board-states", board_state_entry is not None)
+    if board_state_entry:
+        _BOARD_STATES.move_to_end(board_state_key)
+    else:
+        board_state = boardstate.load(game, _rows_to_dicts(boardstate.FIELDNAMES, board_state_rows))
+        board_state_entry = _BOARD_STATES[board_state_key] = {"board": board_state, "validated": collections.OrderedDict()}
+        while len(_BOARD_STATES) > BOARD_STATE_CACHE_SIZE:
+            _BOARD_STATES.popitem(last=False)
+    return _copy_board(board_state_entry["board"]), board_state_entry
+
+def get_board_state_cache_size():
+    return len(_BOARD_STATES)
+
+# Makes the next load of every board state parse and validate it again, e.g.
+# to time those stages.
+def clear_board_state_cache():
+    _BOARD_STATES.clear()
+
+def load_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows, stage_times=None):
+    start_time = time.perf_counter()
+
+    game = get_game(game_name)
+    with _timed_stage(stage_times, "boardstate.load"):
+        board_state, board_state_entry = _load_board_state(game, board_state_rows)
+    with _timed_stage(stage_times, "railroads.load"):
+        railroad_dict = railroads.load(game, board_state, _rows_to_dicts(railroads.FIELDNAMES, railroads_state_rows))
+    with _timed_stage(stage_times, "capture_phase"):
+        game.capture_phase(railroad_dict)
+
+    private_companies = game.get_game_submodule("private_companies")
+    with _timed_stage(stage_times, "private_companies.load"):
+        if private_companies:
+            private_companies.load(game, board_state, railroad_dict, _rows_to_dicts(private_companies.FIELDNAMES, private_companies_rows))
+    # Validation also depends on the stations and phase, so it's skipped only
+    # for a board that's already passed with the same railroads and private
+    # companies.
+    validation_key = _state_key(railroads_state_rows, private_companies_rows)
+    validated = board_state_entry["validated"]
+    if validation_key not in validated:
+        with _timed_stage(stage_times, "validate"):
+            board_state.validate()
+        validated[validation_key] = True
+        while len(validated) > VALIDATED_STATES_PER_BOARD:
+            validated.popitem(last=False)
+    else:
+        validated.move_to_end(validation_key)
+        if stage_times is not None:
+            # A skipped stage is still recorded, so every load has the same stages.
+            stage_times["validate"] = 0.0
+
+    LOG.info("Loaded the %s game state in %.3fs", game_name, time.perf_counter() - start_time)
+
+    return game, board_state, railroad_dict
+
+# Raises a ValueError if the calculation would fail before searching for any
+# routes: the state doesn't parse, breaks the game's rules, or doesn't have the
+# railroad. It's cheap enough to check before queueing the calculation.
+def check_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name=None):
+    with _CHECK_LOCK:
+        railroad_dict = load_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows)[2]
+    if railroad_name is not None:
+        railroad = get_railroad(railroad_dict, railroad_name)
+        if railroad.is_removed:
+            raise ValueError(f"Cannot calculate routes for a removed railroad: {railroad.name}")
+
+def get_railroad(railroad_dict, railroad_name):
+    if railroad_name not in railroad_dict:
+        valid_railroads = ", ".join(railroad_dict.keys())
+        raise ValueError(f"Railroad chosen: \"{railroad_name}\". Valid railroads: {valid_railroads}")
+    return railroad_dict[railroad_name]
+
+def get_operating_railroads(railroad_dict):
+    # Nicknames map to the same railroad objects, so dedupe by name.
+    operating_railroads = {railroad.name: railroad for railroad in railroad_dict.values() if not railroad.is_removed and railroad.trains}
+    return sorted(operating_railroads)
+
+def routes_to_json(routes):
+    return [[
+        str(route.train),
+        [str(space.cell) for space in route],
+        route.value,
+        [(stop.name, route.stop_values[stop]) for stop in route.visited_stops]
+    ] for route in routes]
+
+# Returns the best routes found, and whether they're the best routes or only the
+# best found within the time budget.
+def calculate(game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name, time_budget=None, progress_callback=None,
+        processes=None):
+    game, board_state, railroad_dict = load_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows)
+    return routesearch.search_best_routes(game, board_state, railroad_dict, get_railroad(railroad_dict, railroad_name), processes,
+            time_budget, progress_callback)
+
+def _calculate_batch_railroad(railroad_name, search_processes):
+    game, board_state, railroad_dict = _BATCH_STATE
+    return routes_to_json(routesearch.find_best_routes(game, board_state, railroad_dict, railroad_dict[railroad_name], search_processes))
+
+# Each railroad's search runs its own pool of processes. Cancelling a batch
+# terminates the processes it started, which would otherwise exit without
+# stopping theirs.
+def _terminate_children_on_sigterm():
+    signal.signal(signal.SIGTERM, _terminate_children)
+
+def _terminate_children(signum, frame):
+    for process in multiprocessing.active_children():
+        process.terminate()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+# Finds the best routes for each railroad across a pool of processes, sharing
+# one parsed and validated game state. Each railroad's routes (or error) are
+# passed to result_callback as soon as they're found.
+def calculate_all(game_state, railroad_names, result_callback, processes=None):
+    global _BATCH_STATE
+
+    _BATCH_STATE = game_state
+
+    results = {}
+    try:
+        processes = min(processes or CALCULATE_ALL_PROCESSES, len(railroad_names)) or 1
+        # Split the remaining processes between the railroads' searches.
+        search_processes = max(routesearch.CALCULATOR_PROCESSES // processes, 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("fork"),
+                initializer=_terminate_children_on_sigterm) as executor:
+            futures = {executor.submit(_calculate_batch_railroad, name, search_processes): name for name in railroad_names}
+            for future in concurrent.futures.as_completed(futures):
+                railroad_name = futures[future]
+                try:
+                    results[railroad_name] = {"routes": future.result()}
+                except Exception as exc:
+                    results[railroad_name] = {"error": {"message": str(exc)}}
+                result_callback(railroad_name, results[railroad_name])
+    finally:
+        _BATCH_STATE = None
+
+    return results
@@ -1,28 +1,172 @@
+import contextlib
 import json
+import logging
+import multiprocessing
 import os
+import signal
+import threading
+import time
 import traceback
 
 import redis
-from rq import Worker, Queue, Connection
+from rq import Worker, Queue, Connection, SimpleWorker
 from rq.job import Job
+from rq.logutils import setup_loghandlers
+
+from routes18xxweb.games import get_supported_game_info, preload_game
+from routes18xxweb.logger import get_logger
+
+LOG = get_logger("routes18xxweb.calculator")
 
 listen = ['high', 'default', 'low']
 
+# "fork" runs each job in a forked work-horse, which shares the preloaded game
+# data copy-on-write. "simple" runs jobs in the worker process itself, skipping
+# the fork; a crash takes the worker down, to be restarted by the dyno manager.
+WORKER_MODE = os.getenv("WORKER_MODE", "fork")
+
 redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 
 redis_conn = redis.from_url(redis_url)
 
+JOB_EVENTS_CHANNEL_PREFIX = "calculate-events"
+
+def job_events_channel(job_id):
+    return f"{JOB_EVENTS_CHANNEL_PREFIX}-{job_id}"
+
+# Lets anyone streaming the job's result know to check on it again.
+def publish_job_event(job_id, event):
+    redis_conn.publish(job_events_channel(job_id), event)
+
+JOB_CANCEL_KEY_PREFIX = "calculate-cancel"
+JOB_CANCEL_TTL = 60 * 60
+
+# The signal a work-horse sends itself to stop a cancelled job.
+CANCEL_SIGNAL = signal.SIGUSR1
+
+class JobCancelled(Exception):
+    pass
+
+def job_cancel_key(job_id):
+    return f"{JOB_CANCEL_KEY_PREFIX}-{job_id}"
+
+# Asks whichever worker is running the job to stop it.
+def request_job_cancel(job_id):
+    redis_conn.set(job_cancel_key(job_id), 1, ex=JOB_CANCEL_TTL)
+    publish_job_event(job_id, "cancel")
+
+def is_job_cancel_requested(job_id):
+    return redis_conn.exists(job_cancel_key(job_id)) > 0
+
+def _stop_cancelled_job(signum, frame):
+    # Waiting on the processes the job started (e.g. the route search pool)
+    # would hold up the worker, so they're stopped too.
+    for process in multiprocessing.active_children():
+        process.terminate()
+    raise JobCancelled()
+
+def _watch_for_cancel(job_id, watch):
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    # Check the flag after subscribing, so a request made in between isn't
+    # missed.
+    pubsub.subscribe(job_events_channel(job_id))
+    try:
+        is_cancelled = is_job_cancel_requested(job_id)
+        while not is_cancelled and watch["active"]:
+            message = pubsub.get_message(timeout=1)
+            is_cancelled = bool(message) and message["data"] == b"cancel"
+
+        with watch["lock"]:
+            if is_cancelled and watch["active"]:
+                os.kill(os.getpid(), CANCEL_SIGNAL)
+    finally:
+        pubsub.close()
+
+# Raises JobCancelled in the job as soon as it's cancelled, the same way rq
+# raises JobTimeoutException. That stops it wherever it is, including inside
+# routes18xx or while waiting on other processes.
+@contextlib.contextmanager
+def cancellable(job):
+    previous_handler = signal.signal(CANCEL_SIGNAL, _stop_cancelled_job)
+    watch = {"active": True, "lock": threading.Lock()}
+    threading.Thread(target=_watch_for_cancel, args=(job.id, watch), daemon=True).start()
+    try:
+        yield
+    finally:
+        with watch["lock"]:
+            watch["active"] = False
+        signal.signal(CANCEL_SIGNAL, previous_handler)
+
+# Compares the runtime estimated at enqueue time to the actual runtime, for
+# tuning the cost estimate.
+def _log_job_runtime(job):
+    estimated_runtime = job.meta.get("estimated-runtime")
+    if estimated_runtime is not None and job.started_at and job.ended_at:
+        runtime = (job.ended_at - job.started_at).total_seconds()
+        LOG.info("Job %s (%s): estimated runtime %.3fs, actual runtime %.3fs", job.id, job.origin, estimated_runtime, runtime)
+
+class CalculatorWorker(Worker):
+    def handle_job_success(self, job, queue, started_job_registry):
+        _log_job_runtime(job)
+        super().handle_job_success(job, queue, started_job_registry)
+        # The result has been saved by now, so it's safe to announce.
+        publish_job_event(job.id, "finished")
+
+class SimpleCalculatorWorker(SimpleWorker, CalculatorWorker):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Processes forked by a job (e.g. the route search pool) would otherwise
+        # inherit the worker's shutdown handlers, so terminating them would ask
+        # the worker to shut down instead. Match what rq does for a work-horse.
+        os.register_at_fork(after_in_child=_reset_signal_handlers)
+
+def _reset_signal_handlers():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
 def handle_exception(job, exc_type, exc_value, tb_obj):
+    if issubclass(exc_type, JobCancelled):
+        # Nobody is waiting on the job any more.
+        LOG.info("Stopped cancelled job %s", job.id)
+        job.delete()
+        redis_conn.delete(job_cancel_key(job.id))
+        return False
+
     exc_info_str = json.dumps({
         "message": str(exc_value),
         "traceback": Worker._get_safe_exception_string(traceback.format_exception(exc_type, exc_value, tb_obj))
     })
 
     job.failed_job_registry.add(job, exc_string=exc_info_str)
+    _log_job_runtime(job)
+    publish_job_event(job.id, "failed")
 
     return False
 
+def preload():
+    for game_name in get_supported_game_info():
+        start_time = time.perf_counter()
+        preload_game(game_name)
+        LOG.info("Preloaded %s in %.3fs", game_name, time.perf_counter() - start_time)
+
 def start():
+    start_time = time.perf_counter()
+    preload()
+    LOG.info("Worker ready in %.3fs (%s mode)", time.perf_counter() - start_time, WORKER_MODE)
+
+    # Flushed here, or every forked job would inherit and count the preload's
+    # cache lookups again.
+    from routes18xxweb import metrics
+    metrics.flush_cache_stats(force=True)
+
+    worker_class = SimpleCalculatorWorker if WORKER_MODE == "simple" else CalculatorWorker
     with Connection(redis_conn):
-        worker = Worker(map(Queue, listen), exception_handlers=[handle_exception])
-        worker.work()
\ No newline at end of file
+        worker = worker_class(map(Queue, listen), exception_handlers=[handle_exception])
+        # The scheduler requeues jobs that are waiting to be retried (e.g.
+        # issue reports whose mail failed to send). It logs through the root
+        # logger, which would otherwise set itself up to repeat every message
+        # the worker logs. rq only sets up its own logging if nothing above it
+        # handles its messages, so that has to come first.
+        setup_loghandlers("INFO")
+        logging.getLogger().addHandler(logging.NullHandler())
+        worker.work(with_scheduler=True)
@@ -0,0 +1,65 @@
+import math
+
+from routes18xx.trains import TrainContainer
+
+from routes18xxweb.games import get_board, get_game
+
+# A rough model of how long a calculation takes, from inputs that are cheap to
+# read off the request. Most of the time goes to finding each train's routes,
+# which grows with the stations, the train's reach and the track on the board,
+# then to searching combinations of those routes across the trains, which
+# pruning keeps far below their product. Compare the logged estimates against
+# actual runtimes to tune the constants.
+ROUTES_PER_REACH_TILE = 0.1
+ROUTE_SECONDS = 0.001
+ROUTE_SET_SECONDS = 0.0001
+
+def _board_stop_count(game_name, board_state_rows):
+    game = get_game(game_name)
+    board = get_board(game)
+
+    stop_coords = {str(cell) for cell in board.cells if board.get_space(cell) and board.get_space(cell).is_stop}
+    for row in board_state_rows:
+        if row and row[0] and len(row) > 1 and row[1]:
+            tile = game.tiles.get(row[1])
+            if tile and tile.is_stop:
+                stop_coords.add(row[0])
+    return len(stop_coords)
+
+def _railroad_estimate(railroad_row, stop_count, track_tile_count):
+    trains_str = railroad_row[1].strip() if len(railroad_row) > 1 and railroad_row[1] else ""
+    if not trains_str or trains_str.lower() in ("removed", "closed"):
+        return 0
+
+    station_count = max(len([coord for coord in railroad_row[2].split(",") if coord.strip()]) if len(railroad_row) > 2 and railroad_row[2] else 0, 1)
+
+    route_counts = []
+    for train_str in trains_str.split(","):
+        try:
+            reach = min(TrainContainer.from_string(train_str).visit, stop_count)
+        except ValueError:
+            # The calculation reports invalid trains.
+            continue
+        route_counts.append(max(ROUTES_PER_REACH_TILE * station_count * reach * track_tile_count, 1))
+
+    return ROUTE_SECONDS * sum(route_counts) + ROUTE_SET_SECONDS * math.sqrt(math.prod(route_counts))
+
+def _track_tile_count(board_state_rows):
+    return len([row for row in board_state_rows if row and row[0]])
+
+# The estimated seconds to calculate the railroad's routes.
+def estimate(game_name, railroads_state_rows, board_state_rows, railroad_name):
+    stop_count = _board_stop_count(game_name, board_state_rows)
+    track_tile_count = _track_tile_count(board_state_rows)
+    for row in railroads_state_rows:
+        if row and row[0] == railroad_name:
+            return _railroad_estimate(row, stop_count, track_tile_count)
+    return 0
+
+# The estimated seconds to calculate every railroad's routes, split across the
+# given number of processes.
+def estimate_all(game_name, railroads_state_rows, board_state_rows, processes):
+    stop_count = _board_stop_count(game_name, board_state_rows)
+    track_tile_count = _track_tile_count(board_state_rows)
+    estimates = [_railroad_estimate(row, stop_count, track_tile_count) for row in railroads_state_rows if row and row[0]]
+    return max(sum(estimates) / max(processes, 1), max(estimates, default=0))
@@ -1,51 +1,107 @@
 import collections
+import hashlib
+import importlib.metadata
 import json
 import os
+import pickle
 
 from routes18xx import board, game, railroads, tiles, trains
 
+from routes18xxweb import boardindex
+
 _DIR_NAME = "data"
 _DATA_ROOT_DIR = os.path.abspath(os.path.normpath(os.path.join(os.path.dirname(__file__), _DIR_NAME)))
 
+# Built by build-tile-atlases.py.
+TILE_ATLAS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "static", "images", "tile-atlases"))
+
+# Built by build-game-snapshot.py. Bump SNAPSHOT_VERSION when what goes in the
+# snapshot changes.
+SNAPSHOT_PATH = os.getenv("GAME_SNAPSHOT_PATH", os.path.join(_DATA_ROOT_DIR, "snapshot.pickle"))
+SNAPSHOT_VERSION = 1
+
+PLACEMENT_FILENAMES = ("stations.json", "private-companies.json", "termini.json", "board.json", "rotation-map.json")
+
+_SUPPORTED_GAME_INFO = {}
+
 _GAMES = {}
 _BOARDS = {}
 _RAILROAD_INFO = {}
 _TRAIN_INFO = {}
 _PLACEMENT_INFO = collections.defaultdict(dict)
 _BOARD_LAYOUT = {}
+_BOARD_INDEXES = {}
+_DATA_VERSIONS = {}
+_TILE_ATLASES = {}
+
+# Hits and misses of the caches above, by cache, since metrics last took them.
+_CACHE_STATS = collections.Counter()
 
 def _get_data_file(filename):
     filepath = os.path.join(_DATA_ROOT_DIR, filename)
     with open(filepath) as data_file:
         return json.load(data_file)
 
-def get_supported_game_info():
-    return _get_data_file("supported.json")["games"]
+# Also counts lookups in per-process caches kept outside this module (e.g. the
+# parsed board states in calculation.py), so metrics reports them together.
+def count_cache_lookup(cache_name, is_hit):
+    _CACHE_STATS[(cache_name, is_hit)] += 1
 
+# Returns the (cache name, is hit) lookup counts since the last call.
+def pop_cache_stats():
+    cache_stats = dict(_CACHE_STATS)
+    _CACHE_STATS.clear()
+    return cache_stats
+
+def get_supported_game_info():
+    if not _SUPPORTED_GAME_INFO:
+        _SUPPORTED_GAME_INFO.update(_get_data_file("supported.json")["games"])
+    return _SUPPORTED_GAME_INFO
+
+
+# Identifies the game's data: the routes18xx release, which holds most of it,
+# and the app's own files for the game. Anything derived from only the game's
+# data can be cached for as long as this stays the same.
+def get_data_version(game_name):
+    if game_name not in _DATA_VERSIONS:
+        data_hash = hashlib.sha256(importlib.metadata.version("routes-18xx").encode("utf-8"))
+        game_dir = os.path.join(_DATA_ROOT_DIR, game_name)
+        for filename in sorted(os.listdir(game_dir)):
+            with open(os.path.join(game_dir, filename), "rb") as data_file:
+                data_hash.update(filename.encode("utf-8"))
+                data_hash.update(data_file.read())
+        _DATA_VERSIONS[game_name] = data_hash.hexdigest()[:16]
+    return _DATA_VERSIONS[game_name]
 
 def get_game(game_name):
+    count_cache_lookup("games", game_name in _GAMES)
     if game_name not in _GAMES:
         _GAMES[game_name] = game.Game.load(game_name)
     return _GAMES[game_name]
 
-def _get_config(game_obj, config_dict, load_func):
+def _get_config(game_obj, config_dict, cache_name, load_func):
     game_name = game_obj.name if isinstance(game_obj, game.Game) else game_obj
+    count_cache_lookup(cache_name, game_name in config_dict)
     if game_name not in config_dict:
         config_dict[game_name] = load_func(get_game(game_name))
     return config_dict[game_name]
 
 def get_board(game_obj):
-    return _get_config(game_obj, _BOARDS, board.Board.load)
+    return _get_config(game_obj, _BOARDS, "boards", board.Board.load)
 
 def get_railroad_info(game_obj):
-    return _get_config(game_obj, _RAILROAD_INFO, railroads._load_railroad_info)
+    return _get_config(game_obj, _RAILROAD_INFO, "railroad-info", railroads._load_railroad_info)
 
 def get_train_info(game_obj):
-    return _get_config(game_obj, _TRAIN_INFO, trains.load_train_info)
+    return _get_config(game_obj, _TRAIN_INFO, "train-info", trains.load_train_info)
+
+def get_board_index(game_obj):
+    return _get_config(game_obj, _BOARD_INDEXES, "board-indexes", lambda game_obj: boardindex.build(game_obj, get_board(game_obj)))
 
 
 def _get_placement_info(game_obj, filename):
     game_name = game_obj.name if isinstance(game_obj, game.Game) else game_obj
+    count_cache_lookup("placement-info", game_name in _PLACEMENT_INFO.get(filename, {}))
     if filename not in _PLACEMENT_INFO or game_name not in _PLACEMENT_INFO[filename]:
         filepath = os.path.join(_DATA_ROOT_DIR, game_name, filename)
         if os.path.exists(filepath):
@@ -65,4 +121,87 @@ def get_termini_boundaries(game):
     return _get_placement_info(game, "termini.json")
 
 def get_board_layout(game):
-    return _get_placement_info(game, "board.json")
\ No newline at end of file
+    return _get_placement_info(game, "board.json")
+
+# The file names of the game's tile atlas, and where each tile is in it.
+def get_tile_atlas(game_name):
+    count_cache_lookup("tile-atlases", game_name in _TILE_ATLASES)
+    if game_name not in _TILE_ATLASES:
+        with open(os.path.join(TILE_ATLAS_DIR, f"{game_name}.json")) as atlas_file:
+            _TILE_ATLASES[game_name] = json.load(atlas_file)
+    return _TILE_ATLASES[game_name]
+
+
+# Loads everything the game's calculations and views use, so long-lived
+# processes (and any processes they fork) don't have to later.
+def preload_game(game_name):
+    game_obj = get_game(game_name)
+    get_board(game_obj)
+    get_railroad_info(game_obj)
+    get_train_info(game_obj)
+    get_board_index(game_obj)
+    game_obj.get_game_submodule("private_companies")
+    for filename in PLACEMENT_FILENAMES:
+        _get_placement_info(game_obj, filename)
+    get_tile_atlas(game_name)
+    get_data_version(game_name)
+
+def _get_snapshot_caches():
+    return {
+        "supported-game-info": _SUPPORTED_GAME_INFO,
+        "games": _GAMES,
+        "boards": _BOARDS,
+        "railroad-info": _RAILROAD_INFO,
+        "train-info": _TRAIN_INFO,
+        "placement-info": _PLACEMENT_INFO,
+        "board-indexes": _BOARD_INDEXES,
+        "data-versions": _DATA_VERSIONS,
+        "tile-atlases": _TILE_ATLASES
+    }
+
+# Writes everything preload_game loads for every supported game to one file,
+# so processes can start with it all in one read. It's all loaded afresh, not
+# from the current snapshot.
+def write_snapshot(path=SNAPSHOT_PATH):
+    for cache in _get_snapshot_caches().values():
+        cache.clear()
+
+    for game_name in get_supported_game_info():
+        preload_game(game_name)
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "routes18xx-version": importlib.metadata.version("routes-18xx"),
+        "caches": {name: dict(cache) for name, cache in _get_snapshot_caches().items()}
+    }
+
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+# The snapshot is out of date if the data, or the code that builds what's in
+# it, changed after it was written.
+def _snapshot_is_stale(path):
+    snapshot_mtime = os.path.getmtime(path)
+    source_paths = [__file__, boardindex.__file__]
+    for data_dir in [_DATA_ROOT_DIR, TILE_ATLAS_DIR] + [os.path.join(_DATA_ROOT_DIR, name) for name in os.listdir(_DATA_ROOT_DIR)]:
+        if os.path.isdir(data_dir):
+            source_paths.extend(entry.path for entry in os.scandir(data_dir) if entry.is_file() and entry.path != path)
+    return any(os.path.getmtime(source_path) > snapshot_mtime for source_path in source_paths)
+
+# Fills the caches from the snapshot, unless there isn't one, or it's out of
+# date. Returns whether it did.
+def load_snapshot(path=SNAPSHOT_PATH):
+    if not os.path.exists(path) or _snapshot_is_stale(path):
+        return False
+
+    with open(path, "rb") as snapshot_file:
+        snapshot = pickle.load(snapshot_file)
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("routes18xx-version") != importlib.metadata.version("routes-18xx"):
+        return False
+
+    snapshot_caches = snapshot["caches"]
+    for name, cache in _get_snapshot_caches().items():
+        cache.update(snapshot_caches[name])
+    return True
\ No newline at end of file
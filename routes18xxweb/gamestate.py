@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+
+from routes18xxweb.calculator import redis_conn
+
+REDIS_KEY_PREFIX = "game-state"
+
+STATE_TTL = int(os.getenv("GAME_STATE_TTL", 24 * 60 * 60))
+
+# Tables are sent as rows, each keyed by its first column (coordinate or name).
+# Lists are sent whole, since they're tiny.
+TABLES = ("board", "railroads", "private-companies")
+LISTS = ("removed-railroads", "closed-railroads")
+
+def _canonical_rows(rows):
+    # Empty rows are ignored by the calculation, so they shouldn't affect the state either.
+    return sorted([row for row in rows if any(val for val in row)], key=json.dumps)
+
+def canonicalize(state):
+    canonical_state = {table: _canonical_rows(state.get(table, [])) for table in TABLES}
+    canonical_state.update({name: sorted(state.get(name, [])) for name in LISTS})
+    return canonical_state
+
+# The railroads table, with the removed and closed railroads added as rows, the
+# way the calculation takes them.
+def railroads_state_rows(state):
+    return state["railroads"] \
+            + [[name, "removed"] for name in state["removed-railroads"]] \
+            + [[name, "closed"] for name in state["closed-railroads"]]
+
+def _dumps(state):
+    return json.dumps(state, sort_keys=True, separators=(",", ":"))
+
+def state_id(game_name, state):
+    return hashlib.sha256(f"{game_name}:{_dumps(canonicalize(state))}".encode("utf-8")).hexdigest()
+
+def _state_key(game_name, state_id):
+    return f"{REDIS_KEY_PREFIX}-{game_name}-{state_id}"
+
+def store(game_name, state):
+    canonical_state = canonicalize(state)
+    new_state_id = state_id(game_name, canonical_state)
+    redis_conn.set(_state_key(game_name, new_state_id), _dumps(canonical_state), ex=STATE_TTL)
+    return new_state_id
+
+def load(game_name, state_id):
+    state_json = redis_conn.get(_state_key(game_name, state_id))
+    if not state_json:
+        return None
+
+    # Touch the state, so a game in active use doesn't expire.
+    redis_conn.expire(_state_key(game_name, state_id), STATE_TTL)
+    return json.loads(state_json)
+
+def apply_delta(state, delta):
+    new_state = {}
+    for table in TABLES:
+        table_delta = delta.get(table, {})
+        rows = {row[0]: row for row in state.get(table, [])}
+        for key in table_delta.get("delete", []):
+            rows.pop(key, None)
+        rows.update({row[0]: row for row in table_delta.get("upsert", []) if row})
+        new_state[table] = list(rows.values())
+
+    for name in LISTS:
+        new_state[name] = delta.get(name, state.get(name, []))
+
+    return new_state
@@ -0,0 +1,79 @@
+import functools
+import gzip
+import hashlib
+import os
+
+from flask import g, make_response, request
+
+from routes18xxweb.games import get_data_version
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bump this when the response of any cached endpoint changes for the same game
+# data, so clients don't keep using what they were given before.
+RESPONSE_VERSION = 1
+
+# How long browsers and CDNs can use a response before checking it's still
+# current. It can only change when the app is redeployed, so an hour keeps
+# requests down without leaving clients on old responses for long.
+GAME_RESPONSE_MAX_AGE = int(os.getenv("GAME_RESPONSE_MAX_AGE", 60 * 60))
+
+# Smaller bodies aren't worth compressing.
+MIN_COMPRESS_SIZE = 1024
+
+GZIP_LEVEL = 6
+
+def _get_etag():
+    etag_hash = hashlib.sha256()
+    for part in (RESPONSE_VERSION, get_data_version(g.game_name), request.endpoint, sorted(request.args.items(multi=True))):
+        etag_hash.update(repr(part).encode("utf-8"))
+    return etag_hash.hexdigest()[:32]
+
+def _choose_encoding():
+    if brotli and "br" in request.accept_encodings:
+        return "br"
+    if "gzip" in request.accept_encodings:
+        return "gzip"
+    return None
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data)
+    return gzip.compress(data, GZIP_LEVEL)
+
+# Each encoding of a response is a different representation, so it gets its
+# own strong ETag.
+def _encoded_etag(etag, encoding):
+    return f"{etag}-{encoding}" if encoding else etag
+
+def _set_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = GAME_RESPONSE_MAX_AGE
+    response.vary.add("Accept-Encoding")
+    return response
+
+# For game_app views whose response depends only on the game's data and the
+# query string. Clients that already have the response get a 304 without the
+# view running, and large responses are compressed.
+def cached_game_response(view):
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        etag = _get_etag()
+        for encoding in ("br", "gzip", None):
+            if _encoded_etag(etag, encoding) in request.if_none_match:
+                return _set_cache_headers(make_response("", 304), _encoded_etag(etag, encoding))
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+
+        encoding = _choose_encoding() if response.content_length and response.content_length >= MIN_COMPRESS_SIZE else None
+        if encoding:
+            response.set_data(_compress(response.get_data(), encoding))
+            response.content_encoding = encoding
+        return _set_cache_headers(response, _encoded_etag(etag, encoding))
+    return cached_view
@@ -1,5 +1,11 @@
+import atexit
+import datetime
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import sys
 
 
@@ -8,7 +14,87 @@ LOG_LEVEL_MAP = {
     1: logging.INFO,
     2: logging.DEBUG
 }
-MAX_LOG_LEVEL = max(LOG_LEVEL_MAP.values())
+MAX_LOG_LEVEL = max(LOG_LEVEL_MAP.keys())
+
+# "json" for one JSON object per line, or "text".
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").strip().lower()
+TEXT_LOG_FORMAT = "%(asctime)s %(name)s: %(message)s"
+
+# Longer messages (e.g. a large game state) are cut off at this many characters.
+MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", 2000))
+
+# The attributes every LogRecord has, so anything else was passed as extra.
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def _truncate(message):
+    if len(message) <= MAX_MESSAGE_LENGTH:
+        return message
+    return f"{message[:MAX_MESSAGE_LENGTH]}... ({len(message)} characters)"
+
+class TextFormatter(logging.Formatter):
+    def formatMessage(self, record):
+        record.message = _truncate(record.message)
+        return super().formatMessage(record)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": _truncate(record.getMessage())
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+# Drops the given share of the logger's records below WARNING.
+class SampleFilter(logging.Filter):
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.sample_rate
+
+# Hands records to a thread that formats and writes them, so logging doesn't
+# hold up requests. Processes forked after logging was set up (e.g. rq
+# work-horses) exit without flushing the queue, so they log synchronously.
+class BackgroundHandler(logging.handlers.QueueHandler):
+    def __init__(self, output_handler):
+        super().__init__(queue.SimpleQueue())
+        self.output_handler = output_handler
+        self.listener = logging.handlers.QueueListener(self.queue, output_handler)
+        self.listener_pid = os.getpid()
+        self.listener.start()
+        atexit.register(self.flush)
+
+    def prepare(self, record):
+        # Formatting is left to the listener's thread. Records never leave the
+        # process, so they don't need to be made picklable.
+        return record
+
+    def enqueue(self, record):
+        if os.getpid() == self.listener_pid:
+            self.queue.put_nowait(record)
+        else:
+            self.output_handler.handle(record)
+
+    # Waits for the queued records to be written.
+    def flush(self):
+        if os.getpid() == self.listener_pid and self.listener._thread:
+            self.listener.stop()
+            self.listener.start()
+
+_HANDLERS = {}
+
+def _get_handler():
+    if "background" not in _HANDLERS:
+        output_handler = logging.StreamHandler(stream=sys.stdout)
+        output_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(TEXT_LOG_FORMAT))
+        _HANDLERS["background"] = BackgroundHandler(output_handler)
+    return _HANDLERS["background"]
 
 def get_level(tracking_env_var_name=None, default_level=1):
     if tracking_env_var_name:
@@ -27,15 +113,25 @@ def get_level(tracking_env_var_name=None, default_level=1):
         log_level = default_level
     return LOG_LEVEL_MAP[log_level]
 
+def get_sample_rate(sample_rate_env_var_name, default_rate=1.0):
+    try:
+        sample_rate = float(os.environ.get(sample_rate_env_var_name, str(default_rate)).strip())
+    except ValueError:
+        sample_rate = default_rate
+    return min(max(sample_rate, 0.0), 1.0)
+
 def get_logger(name=None):
     return logging.getLogger(name) if name else logging.getLogger()
 
 def init_logger(logger, tracking_env_var_name=None, default_level=1):
-    handler = logging.StreamHandler(stream=sys.stdout)
-    logger.addHandler(handler)
+    logger.addHandler(_get_handler())
     logger.setLevel(get_level(tracking_env_var_name, default_level))
     return logger
 
-def set_log_format(logger, log_format="%(asctime)s %(name)s: %(message)s"):
-    for handler in logger.handlers:
-        handler.setFormatter(logging.Formatter(log_format))
\ No newline at end of file
+# Logs only a share of the logger's records below WARNING, e.g. for one that
+# logs whole game states. Its records still go to its parent's handlers.
+def set_sample_rate(logger, sample_rate_env_var_name, default_rate=1.0):
+    sample_rate = get_sample_rate(sample_rate_env_var_name, default_rate)
+    if sample_rate < 1.0:
+        logger.addFilter(SampleFilter(sample_rate))
+    return logger
@@ -0,0 +1,84 @@
+import base64
+import datetime
+import importlib
+import json
+import os
+import uuid
+
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail, Attachment
+
+from routes18xxweb.logger import get_logger
+
+LOG = get_logger("routes18xxweb.mail")
+
+# How mail is sent: "sendgrid", "file" to write each message to MAIL_FILE_DIR
+# instead (e.g. to try out issue reports locally), "dummy" to only log it, or
+# "module:function" for any other function that takes a message.
+MAIL_BACKEND = os.getenv("MAIL_BACKEND", "sendgrid")
+MAIL_FILE_DIR = os.getenv("MAIL_FILE_DIR", "sent-mail")
+
+# Messages are plain dicts, so they can be queued and sent by a worker.
+def create_message(from_email, to_email, subject, body):
+    return {
+        "from": from_email,
+        "to": to_email,
+        "subject": subject,
+        "body": body,
+        "attachments": []
+    }
+
+def attach(message, filename, content, file_type):
+    message["attachments"].append({"filename": os.path.basename(filename), "content": content, "type": file_type})
+
+def _send_with_sendgrid(message):
+    msg = Mail(
+        from_email=message["from"],
+        to_emails=message["to"],
+        subject=message["subject"],
+        plain_text_content=message["body"])
+
+    for attachment in message["attachments"]:
+        encoded_content = base64.b64encode(attachment["content"]).decode()
+        msg.add_attachment(
+            Attachment(file_content=encoded_content, file_type=attachment["type"], file_name=attachment["filename"])
+        )
+
+    # Raises an HTTPError if SendGrid doesn't accept it.
+    SendGridAPIClient(os.environ.get('SENDGRID_API_KEY')).send(msg)
+
+# Writes the message to its own directory: its headers and body to
+# message.json, and each attachment to a file.
+def _send_to_file(message):
+    message_dir = os.path.join(MAIL_FILE_DIR, f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(message_dir)
+
+    for attachment in message["attachments"]:
+        with open(os.path.join(message_dir, attachment["filename"]), "wb") as attachment_file:
+            attachment_file.write(attachment["content"])
+
+    headers = {key: value for key, value in message.items() if key != "attachments"}
+    headers["attachments"] = [attachment["filename"] for attachment in message["attachments"]]
+    with open(os.path.join(message_dir, "message.json"), "w") as message_file:
+        json.dump(headers, message_file, indent=4)
+
+def _send_nowhere(message):
+    pass
+
+_BACKENDS = {
+    "sendgrid": _send_with_sendgrid,
+    "file": _send_to_file,
+    "dummy": _send_nowhere
+}
+
+def _get_backend():
+    if MAIL_BACKEND in _BACKENDS:
+        return _BACKENDS[MAIL_BACKEND]
+
+    module_name, _, func_name = MAIL_BACKEND.partition(":")
+    return getattr(importlib.import_module(module_name), func_name)
+
+# Runs as a job. If the backend raises, the job fails, and rq retries it.
+def send(message):
+    _get_backend()(message)
+    LOG.info("Sent \"%s\" to %s with %s (%d attachments)", message["subject"], message["to"], MAIL_BACKEND, len(message["attachments"]))
@@ -0,0 +1,155 @@
+import collections
+import os
+import socket
+import time
+
+from routes18xxweb import games
+from routes18xxweb.calculator import redis_conn
+
+# Metrics are kept in Redis, so the worker's and every web process's end up in
+# one place for /metrics to expose.
+COUNTERS_KEY = "metrics-counters"
+GAUGES_KEY = "metrics-gauges"
+HISTOGRAM_KEY_PREFIX = "metrics-histogram"
+HISTOGRAMS_KEY = f"{HISTOGRAM_KEY_PREFIX}s"
+
+# In seconds, from a quick request to a calculation that runs up against its
+# timeout.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# How often a process adds its games.py cache lookups to the counters.
+CACHE_STATS_FLUSH_INTERVAL = 10
+
+METRIC_NAME_PREFIX = "routes18xx"
+
+# Labels gauges only a process can report, like the size of its caches. The
+# dyno name stays the same across restarts.
+PROCESS_NAME = os.getenv("DYNO", socket.gethostname())
+
+_LAST_CACHE_STATS_FLUSH = {"time": 0}
+
+def _series(name, labels):
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+# Adds the increment to a pipeline, which can be an asyncio one.
+def queue_increment(pipe, name, amount=1, labels=None):
+    pipe.hincrby(COUNTERS_KEY, _series(name, labels), amount)
+
+def increment(name, amount=1, labels=None):
+    redis_conn.hincrby(COUNTERS_KEY, _series(name, labels), amount)
+
+def get_counters():
+    return {name.decode("utf-8"): int(value) for name, value in redis_conn.hgetall(COUNTERS_KEY).items()}
+
+# For gauges set by the processes they describe, rather than read when scraped.
+def set_gauge(name, value, labels=None):
+    redis_conn.hset(GAUGES_KEY, _series(name, labels), value)
+
+def get_gauges():
+    return {name.decode("utf-8"): float(value) for name, value in redis_conn.hgetall(GAUGES_KEY).items()}
+
+def _histogram_key(name):
+    return f"{HISTOGRAM_KEY_PREFIX}-{name}"
+
+# Adds the observation to a pipeline, which can be an asyncio one.
+def queue_observation(pipe, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    series = _series("", labels)
+    bucket = next((str(bound) for bound in buckets if value <= bound), "+Inf")
+    pipe.sadd(HISTOGRAMS_KEY, name)
+    pipe.hincrby(_histogram_key(name), f"{series}|{bucket}", 1)
+    pipe.hincrby(_histogram_key(name), f"{series}|count", 1)
+    pipe.hincrbyfloat(_histogram_key(name), f"{series}|sum", value)
+
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    with redis_conn.pipeline(transaction=False) as pipe:
+        queue_observation(pipe, name, value, labels, buckets)
+        pipe.execute()
+
+# Returns histogram name -> label string -> {"buckets": {bound: count}, "count": count, "sum": sum}.
+# Bucket counts aren't cumulative.
+def get_histograms():
+    histograms = {}
+    for name in sorted(name.decode("utf-8") for name in redis_conn.smembers(HISTOGRAMS_KEY)):
+        histogram = collections.defaultdict(lambda: {"buckets": {}, "count": 0, "sum": 0.0})
+        for field, value in redis_conn.hgetall(_histogram_key(name)).items():
+            series, stat = field.decode("utf-8").rsplit("|", 1)
+            if stat == "sum":
+                histogram[series]["sum"] = float(value)
+            elif stat == "count":
+                histogram[series]["count"] = int(value)
+            else:
+                histogram[series]["buckets"][stat] = int(value)
+        histograms[name] = histogram
+    return histograms
+
+# Adds the process's cache lookups since it last did so to the counters. Unless
+# forced, it only does so every CACHE_STATS_FLUSH_INTERVAL seconds.
+def flush_cache_stats(force=False):
+    if not force and time.monotonic() - _LAST_CACHE_STATS_FLUSH["time"] < CACHE_STATS_FLUSH_INTERVAL:
+        return
+    _LAST_CACHE_STATS_FLUSH["time"] = time.monotonic()
+
+    cache_stats = games.pop_cache_stats()
+    if cache_stats:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for (cache_name, is_hit), count in cache_stats.items():
+                pipe.hincrby(COUNTERS_KEY, _series("games-cache-lookups", {"cache": cache_name, "result": "hit" if is_hit else "miss"}), count)
+            pipe.execute()
+
+def _metric_name(name):
+    return f"{METRIC_NAME_PREFIX}_{name.replace('-', '_')}"
+
+def _split_series(series):
+    name, _, labels = series.partition("{")
+    return name, labels.rstrip("}")
+
+def _bucket_labels(labels, bound):
+    bound_label = f'le="{bound if bound == "+Inf" else float(bound)}"'
+    return f"{{{labels},{bound_label}}}" if labels else f"{{{bound_label}}}"
+
+# Renders the counters, histograms and set gauges, plus the given gauges
+# (name -> label string -> value), in the Prometheus text format.
+def render(gauges=None):
+    lines = []
+
+    all_gauges = collections.defaultdict(dict, gauges or {})
+    for series, value in get_gauges().items():
+        name, labels = _split_series(series)
+        all_gauges[name][labels] = value
+
+    counters = collections.defaultdict(dict)
+    for series, value in get_counters().items():
+        name, labels = _split_series(series)
+        counters[name][labels] = value
+    for name in sorted(counters):
+        metric_name = f"{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric_name} counter")
+        for labels, value in sorted(counters[name].items()):
+            lines.append(f"{metric_name}{{{labels}}} {value}" if labels else f"{metric_name} {value}")
+
+    for name, histogram in get_histograms().items():
+        metric_name = _metric_name(name)
+        lines.append(f"# TYPE {metric_name} histogram")
+        for series, stats in sorted(histogram.items()):
+            labels = series.strip("{}")
+            # Every series gets the default buckets, even ones it has no
+            # observations in, so they line up across series.
+            bounds = {str(bound) for bound in DEFAULT_BUCKETS} | set(stats["buckets"]) - {"+Inf"}
+            cumulative_count = 0
+            for bound in sorted(bounds, key=float):
+                cumulative_count += stats["buckets"].get(bound, 0)
+                lines.append(f"{metric_name}_bucket{_bucket_labels(labels, bound)} {cumulative_count}")
+            lines.append(f"{metric_name}_bucket{_bucket_labels(labels, '+Inf')} {stats['count']}")
+            lines.append(f"{metric_name}_sum{{{labels}}} {stats['sum']}" if labels else f"{metric_name}_sum {stats['sum']}")
+            lines.append(f"{metric_name}_count{{{labels}}} {stats['count']}" if labels else f"{metric_name}_count {stats['count']}")
+
+    for name, series_values in sorted(all_gauges.items()):
+        metric_name = _metric_name(name)
+        lines.append(f"# TYPE {metric_name} gauge")
+        for labels, value in sorted(series_values.items()):
+            lines.append(f"{metric_name}{{{labels}}} {value}" if labels else f"{metric_name} {value}")
+
+    return "\n".join(lines) + "\n"
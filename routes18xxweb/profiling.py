@@ -0,0 +1,77 @@
+import contextlib
+import cProfile
+import hmac
+import io
+import marshal
+import os
+import pstats
+import random
+import zlib
+
+from routes18xxweb.calculator import redis_conn
+
+REDIS_KEY_PREFIX = "calculate-profile"
+
+# Profiles are kept long enough to be looked at after a user reports a slow
+# calculation, which can be a while after it ran.
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", 24 * 60 * 60))
+
+# The share of calculations profiled at random. Admins can ask for a profile by
+# sending PROFILE_ADMIN_TOKEN with the request.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+
+SUMMARY_SORT_KEYS = ("cumulative", "tottime", "ncalls")
+
+# The most functions a summary lists.
+MAX_SUMMARY_LIMIT = 200
+
+def _profile_key(job_id):
+    return f"{REDIS_KEY_PREFIX}-{job_id}"
+
+def is_admin_request(token):
+    return bool(PROFILE_ADMIN_TOKEN and token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+def should_profile(token):
+    return is_admin_request(token) or random.random() < PROFILE_SAMPLE_RATE
+
+# Profiles the block, then stores the stats under the job, even if the job
+# failed or timed out.
+@contextlib.contextmanager
+def profiled(job_id):
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.create_stats()
+        # The same format pstats dumps to a file, so it can be downloaded and
+        # loaded as is.
+        redis_conn.set(_profile_key(job_id), zlib.compress(marshal.dumps(profile.stats)), ex=PROFILE_TTL)
+
+# Returns the stats in the pstats file format, or None if the job wasn't
+# profiled.
+def get_stats(job_id):
+    stats = redis_conn.get(_profile_key(job_id))
+    return zlib.decompress(stats) if stats else None
+
+# pstats.Stats loads from a file name or a profiler, so this passes the stored
+# stats off as the latter.
+class _StoredProfile:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+# Returns the top functions in the profile as text, or None if the job wasn't
+# profiled.
+def get_summary(job_id, limit=30, sort_key="cumulative"):
+    stats = get_stats(job_id)
+    if stats is None:
+        return None
+
+    summary = io.StringIO()
+    pstats.Stats(_StoredProfile(marshal.loads(stats)), stream=summary).sort_stats(sort_key).print_stats(limit)
+    return summary.getvalue()
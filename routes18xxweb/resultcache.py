@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import time
+
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from routes18xxweb import metrics
+from routes18xxweb.calculator import is_job_cancel_requested, redis_conn
+
+REDIS_KEY_PREFIX = "calculate-cache"
+INDEX_KEY = f"{REDIS_KEY_PREFIX}-index"
+
+# The version of the stored result JSON. Bump it when the JSON changes shape,
+# so results stored in the old shape are never handed out.
+RESULT_VERSION = 1
+RESULT_KEY_PREFIX = f"calculate-result-v{RESULT_VERSION}"
+
+CACHE_TTL = int(os.getenv("CALCULATE_CACHE_TTL", 600))
+CACHE_MAX_ENTRIES = int(os.getenv("CALCULATE_CACHE_MAX_ENTRIES", 1000))
+
+# The state ID is already a hash of the canonical game state.
+def request_key(game_name, state_id, railroad_name, time_budget=None):
+    return hashlib.sha256(json.dumps([RESULT_VERSION, game_name, state_id, railroad_name, time_budget]).encode("utf-8")).hexdigest()
+
+def _entry_key(key):
+    return f"{REDIS_KEY_PREFIX}-{key}"
+
+# The set of client IDs waiting on the job.
+def waiters_key(job_id):
+    return f"{REDIS_KEY_PREFIX}-waiting-clients-{job_id}"
+
+def result_key(job_id):
+    return f"{RESULT_KEY_PREFIX}-{job_id}"
+
+# Returns the queued, running or finished job for the request key, or None on
+# a miss.
+def get_job(key):
+    job_id = redis_conn.get(_entry_key(key))
+    job = None
+    if job_id:
+        try:
+            job = Job.fetch(job_id.decode("utf-8"), connection=redis_conn)
+        except NoSuchJobError:
+            pass
+
+    # A failed or cancelled job shouldn't be handed out again, so the request
+    # gets retried.
+    if job and not job.is_failed and not is_job_cancel_requested(job.id):
+        metrics.increment("calculate-cache-hits")
+        return job
+
+    metrics.increment("calculate-cache-misses")
+    return None
+
+def put_job(key, job_id):
+    with redis_conn.pipeline() as pipe:
+        pipe.set(_entry_key(key), job_id, ex=CACHE_TTL)
+        pipe.zadd(INDEX_KEY, {key: time.time()})
+        pipe.execute()
+    _evict()
+
+def _evict():
+    redis_conn.zremrangebyscore(INDEX_KEY, "-inf", time.time() - CACHE_TTL)
+
+    overflow = redis_conn.zcard(INDEX_KEY) - CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted_keys = redis_conn.zrange(INDEX_KEY, 0, overflow - 1)
+        with redis_conn.pipeline() as pipe:
+            pipe.delete(*[_entry_key(key.decode("utf-8")) for key in evicted_keys])
+            pipe.zrem(INDEX_KEY, *evicted_keys)
+            pipe.execute()
+        metrics.increment("calculate-cache-evictions", len(evicted_keys))
+
+# A client that submits the same state again is still only one waiter.
+def add_waiter(job_id, client_id):
+    with redis_conn.pipeline() as pipe:
+        pipe.sadd(waiters_key(job_id), client_id)
+        pipe.expire(waiters_key(job_id), CACHE_TTL)
+        pipe.execute()
+
+# Returns how many other clients are still waiting on the job.
+def remove_waiter(job_id, client_id):
+    with redis_conn.pipeline() as pipe:
+        pipe.srem(waiters_key(job_id), client_id)
+        pipe.scard(waiters_key(job_id))
+        return pipe.execute()[1]
+
+# Stores a finished job's result as the JSON the result endpoints return.
+def save_result(job_id, result_json):
+    result = json.dumps(dict(result_json, version=RESULT_VERSION), separators=(",", ":"))
+    redis_conn.set(result_key(job_id), result, ex=CACHE_TTL)
+
+# Returns the stored result JSON as bytes, or None if the job hasn't finished.
+def get_result(job_id):
+    return redis_conn.get(result_key(job_id))
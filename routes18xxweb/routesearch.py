@@ -0,0 +1,373 @@
+import importlib
+import math
+import multiprocessing
+import os
+import time
+
+from routes18xx.route import Route, RouteSet
+
+from routes18xxweb.logger import get_logger
+
+# The package exports the find_best_routes function under the module's name.
+_routes18xx = importlib.import_module("routes18xx.find_best_routes")
+
+LOG = get_logger("routes18xxweb.routesearch")
+
+CALCULATOR_PROCESSES = int(os.getenv("CALCULATOR_PROCESSES", os.cpu_count()))
+
+# The most often a search reports its progress, in seconds.
+PROGRESS_INTERVAL = float(os.getenv("CALCULATE_PROGRESS_INTERVAL", 1))
+
+# State shared with the search processes. They're forked after it's set, so
+# none of it needs to be pickled, and routes can be referred to by index.
+_SEARCH_STATE = None
+
+# The best value found so far, as seen by a search of the routes starting with
+# one root route. Comparisons against it mirror the ones
+# routes18xx.find_best_routes makes against its shared best value. A search
+# can begin from a guess of that value, so it also tracks the range of
+# starting values that would have made every comparison come out the same way.
+# Any starting value in that range produces exactly the same result.
+# Past the deadline, if there is one, the search stops early and the result is
+# only the best it found.
+class _Bound:
+    def __init__(self, start_value, deadline=None):
+        self.start_value = start_value
+        self.found_value = 0
+        self.lowest = -math.inf
+        self.highest = math.inf
+        self.deadline = deadline
+        self.timed_out = False
+
+    @property
+    def value(self):
+        return max(self.start_value, self.found_value)
+
+    # if value > bound: bound = value
+    def update(self, value):
+        if value <= self.found_value:
+            return False
+        elif value > self.start_value:
+            self.highest = min(self.highest, value - 1)
+            self.found_value = value
+            return True
+        else:
+            self.lowest = max(self.lowest, value)
+            return False
+
+    # if value <= bound: prune
+    def prunes(self, value):
+        if value <= self.found_value:
+            return True
+        elif value <= self.start_value:
+            self.lowest = max(self.lowest, value)
+            return True
+        else:
+            self.highest = min(self.highest, value - 1)
+            return False
+
+    # if value >= bound: bound = value
+    def accepts(self, value):
+        if value < self.found_value:
+            return False
+        elif value >= self.start_value:
+            self.highest = min(self.highest, value)
+            self.found_value = value
+            return True
+        else:
+            self.lowest = max(self.lowest, value + 1)
+            return False
+
+    def holds_for(self, start_value):
+        return self.lowest <= start_value <= self.highest
+
+    def out_of_time(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.timed_out = True
+        return self.timed_out
+
+# Reports the best route set found so far, and roughly how much of the search
+# is done, at most once every PROGRESS_INTERVAL seconds. Until the trains'
+# routes have all been found, there's no route set to report, only how many
+# have been.
+class _Progress:
+    def __init__(self, callback):
+        self.callback = callback
+        self.root_count = 0
+        self.searched_roots = 0
+        self.train_set_searched_roots = 0
+        self.best_route_set = None
+        self.last_report_time = time.monotonic()
+
+    def update(self, route_set):
+        if route_set and (self.best_route_set is None or route_set.value > self.best_route_set.value):
+            self.best_route_set = route_set
+        self.train_set_searched_roots += 1
+        self._report()
+
+    # Roots that were pruned without being searched count as done too.
+    def finish_train_set(self, root_count):
+        self.searched_roots += root_count
+        self.train_set_searched_roots = 0
+        self._report()
+
+    def find_routes(self, found_share):
+        if self.callback and time.monotonic() - self.last_report_time >= PROGRESS_INTERVAL:
+            self.last_report_time = time.monotonic()
+            self.callback(None, min(found_share, 1))
+
+    def _report(self):
+        if self.callback and self.best_route_set is not None and time.monotonic() - self.last_report_time >= PROGRESS_INTERVAL:
+            self.last_report_time = time.monotonic()
+            self.callback(self.best_route_set, min((self.searched_roots + self.train_set_searched_roots) / max(self.root_count, 1), 1))
+
+# The same search as routes18xx.find_best_routes._find_best_sub_route_set. Once
+# it's out of time, it returns the best route set found so far, after trying
+# at least one route at each level so the route set uses every train it can.
+def _find_best_sub_route_set(game, railroad, bound, sorted_routes, selected_routes):
+    best_route_set = RouteSet.create(game, railroad, selected_routes)
+    bound.update(best_route_set.value)
+
+    for minor_route in sorted_routes[0]:
+        if not _routes18xx._is_overlapping(minor_route, selected_routes):
+            if sorted_routes[1:]:
+                max_possible_route_set = RouteSet.create(game, railroad, selected_routes + [minor_route] + [routes[0] for routes in sorted_routes[1:]])
+                if bound.prunes(max_possible_route_set.value):
+                    return best_route_set
+
+                sub_route_set = _find_best_sub_route_set(game, railroad, bound, sorted_routes[1:], selected_routes + [minor_route])
+                if bound.accepts(sub_route_set.value):
+                    best_route_set = sub_route_set
+
+                if bound.out_of_time():
+                    return best_route_set
+            else:
+                return RouteSet.create(game, railroad, selected_routes + [minor_route])
+    return best_route_set
+
+def _search_root(game, railroad, sorted_routes, root_index, start_value, deadline):
+    bound = _Bound(start_value, deadline)
+    route_set = _find_best_sub_route_set(game, railroad, bound, sorted_routes[1:], [sorted_routes[0][root_index]])
+    return route_set, bound
+
+# Also returns whether the routes from every station were found before the
+# deadline. Those from the first station always are, so the train can run.
+# station_callback is called after each station.
+def _get_train_routes(game, board, railroad, train, deadline=None, station_callback=None):
+    stations = board.stations(railroad.name)
+
+    routes = set()
+    is_finished = True
+    for index, station in enumerate(stations):
+        if index > 0 and deadline is not None and time.monotonic() >= deadline:
+            is_finished = False
+            break
+
+        routes.update(_routes18xx._find_routes_from_cell(game, board, railroad, station.cell, train))
+        routes.update(_routes18xx._find_connected_routes(game, board, railroad, station, train))
+        if station_callback:
+            station_callback()
+    routes.update(_routes18xx._get_subroutes(routes, stations))
+    return _routes18xx._filter_invalid_routes(game, routes, board, railroad), is_finished
+
+def _find_train_routes_worker(train):
+    game, board, railroad, deadline = _SEARCH_STATE
+    # Return the routes as coords, in the order they were found. The parent
+    # rebuilds them from its own board, since routes compare their spaces by
+    # identity.
+    routes, is_finished = _get_train_routes(game, board, railroad, train, deadline)
+    return [[str(tile.cell) for tile in route] for route in routes], is_finished
+
+def _search_root_worker(task):
+    game, railroad, train_set_routes, best_values, finished, deadline = _SEARCH_STATE
+    train_set_index, root_index = task
+    if finished[train_set_index] or (deadline is not None and time.monotonic() >= deadline):
+        return None
+
+    sorted_routes = train_set_routes[train_set_index]
+    # Share the best value found with the other processes, so they can prune
+    # the same way. A guess that turns out too high is caught by the bound.
+    route_set, bound = _search_root(game, railroad, sorted_routes, root_index, best_values[train_set_index], deadline)
+    with best_values.get_lock():
+        best_values[train_set_index] = max(best_values[train_set_index], bound.found_value)
+
+    route_indexes = [sorted_routes[column].index(route.__dict__["route"]) for column, route in enumerate(route_set)]
+    return route_indexes, bound
+
+def _pool(processes, state):
+    global _SEARCH_STATE
+
+    _SEARCH_STATE = state
+    return multiprocessing.get_context("fork").Pool(processes)
+
+# Returns each distinct train's routes, and whether they were all found before
+# the deadline.
+def _find_all_routes(game, board, railroad, processes, deadline, progress):
+    global _SEARCH_STATE
+
+    trains = []
+    for train in railroad.trains:
+        if train not in trains:
+            trains.append(train)
+
+    if processes == 1 or len(trains) == 1:
+        station_count = max(len(board.stations(railroad.name)) * len(trains), 1)
+        searched_stations = []
+
+        def station_searched():
+            searched_stations.append(None)
+            progress.find_routes(len(searched_stations) / station_count)
+
+        routes, is_finished = {}, True
+        for train in trains:
+            routes[train], train_is_finished = _get_train_routes(game, board, railroad, train, deadline, station_searched)
+            is_finished = is_finished and train_is_finished
+        return routes, is_finished
+
+    routes_coords = []
+    try:
+        with _pool(min(processes, len(trains)), (game, board, railroad, deadline)) as pool:
+            for train_routes_coords in pool.imap(_find_train_routes_worker, trains, chunksize=1):
+                routes_coords.append(train_routes_coords)
+                progress.find_routes(len(routes_coords) / len(trains))
+    finally:
+        _SEARCH_STATE = None
+
+    routes = {train: [Route.create([board.get_space(board.cell(coord)) for coord in route_coords]) for route_coords in train_routes_coords]
+            for train, (train_routes_coords, _) in zip(trains, routes_coords)}
+    return routes, all(is_finished for _, is_finished in routes_coords)
+
+# Replays the top level of _find_best_sub_route_set, using each root route's
+# speculative result only if it holds for the value found so far. Also returns
+# whether the search finished before the deadline.
+def _search_train_set(game, railroad, sorted_routes, root_results, deadline, progress):
+    best_route_set = RouteSet.create(game, railroad, [])
+    best_value = max(best_route_set.value, 0)
+
+    for root_index, root_route in enumerate(sorted_routes[0]):
+        if not sorted_routes[1:]:
+            return RouteSet.create(game, railroad, [root_route]), True
+
+        max_possible_route_set = RouteSet.create(game, railroad, [root_route] + [routes[0] for routes in sorted_routes[1:]])
+        if max_possible_route_set.value <= best_value:
+            break
+
+        # Always search the first root route, so there's a route set to return.
+        if root_index > 0 and deadline is not None and time.monotonic() >= deadline:
+            return best_route_set, False
+
+        root_result = next(root_results, None)
+        # There's no time to search a root route again.
+        if root_result and (root_result[1].timed_out or root_result[1].holds_for(best_value)):
+            route_indexes, bound = root_result
+            route_set = RouteSet.create(game, railroad, [sorted_routes[column][index] for column, index in enumerate(route_indexes)])
+        else:
+            if root_result:
+                LOG.debug("Searching the route sets starting with %s again, from a best value of %s.", root_route, best_value)
+            route_set, bound = _search_root(game, railroad, sorted_routes, root_index, best_value, deadline)
+
+        best_value = max(best_value, bound.found_value)
+        if route_set.value >= best_value:
+            best_route_set = route_set
+            best_value = route_set.value
+
+        progress.update(best_route_set)
+        if bound.timed_out:
+            return best_route_set, False
+
+    return best_route_set, True
+
+def _find_best_route_sets(game, railroad, train_sets, train_set_routes, processes, deadline, progress):
+    global _SEARCH_STATE
+
+    progress.root_count = sum(len(sorted_routes[0]) for sorted_routes in train_set_routes if all(sorted_routes))
+    searched = [index for index, sorted_routes in enumerate(train_set_routes) if all(sorted_routes) and sorted_routes[1:]]
+    if processes == 1 or not searched:
+        train_set_results = []
+        for sorted_routes in train_set_routes:
+            if all(sorted_routes):
+                train_set_results.append(_search_train_set(game, railroad, sorted_routes, iter(()), deadline, progress))
+                progress.finish_train_set(len(sorted_routes[0]))
+        return train_set_results
+
+    best_values = multiprocessing.Array("i", len(train_sets))
+    finished = multiprocessing.Array("b", len(train_sets), lock=False)
+    tasks = [(index, root_index) for index in searched for root_index in range(len(train_set_routes[index][0]))]
+    chunk_size = max(1, len(tasks) // (processes * 8))
+    try:
+        with _pool(processes, (game, railroad, train_set_routes, best_values, finished, deadline)) as pool:
+            results = pool.imap(_search_root_worker, tasks, chunksize=chunk_size)
+
+            train_set_results = []
+            for index, sorted_routes in enumerate(train_set_routes):
+                if not all(sorted_routes):
+                    continue
+
+                root_results = iter(())
+                if index in searched:
+                    root_results = (next(results) for _ in range(len(sorted_routes[0])))
+
+                train_set_results.append(_search_train_set(game, railroad, sorted_routes, root_results, deadline, progress))
+                progress.finish_train_set(len(sorted_routes[0]))
+
+                # Skip the rest of the train set's results, so the next train
+                # set starts at its own.
+                finished[index] = 1
+                for _ in root_results:
+                    pass
+    finally:
+        _SEARCH_STATE = None
+
+    return train_set_results
+
+# Finds the same routes as routes18xx.find_best_routes running in a single
+# process, spreading the work across processes.
+#  - Each distinct train's routes are found in its own process.
+#  - The route sets starting with each of the first train's routes are searched
+#    speculatively across the processes, then the results are checked in order.
+def find_best_routes(game, board, railroads, active_railroad, processes=None):
+    return search_best_routes(game, board, railroads, active_railroad, processes)[0]
+
+# The same search as find_best_routes, which can stop once it's taken
+# time_budget seconds, either while finding the trains' routes or while
+# searching them. Returns the best route set found, and whether the search
+# finished, making it the one find_best_routes returns. While searching, the
+# best route set so far and the share of the search done are passed to
+# progress_callback now and then. Before there's a route set, it's passed None
+# and the share of the routes found.
+def search_best_routes(game, board, railroads, active_railroad, processes=None, time_budget=None, progress_callback=None):
+    if active_railroad.is_removed:
+        raise ValueError(f"Cannot calculate routes for a removed railroad: {active_railroad.name}")
+
+    processes = processes or CALCULATOR_PROCESSES
+    deadline = time.monotonic() + time_budget if time_budget else None
+
+    game.capture_phase(railroads)
+
+    progress = _Progress(progress_callback)
+    routes, found_all_routes = _find_all_routes(game, board, active_railroad, processes, deadline, progress)
+
+    sorted_routes_by_train = {}
+    for train, train_routes in routes.items():
+        route_values = [route.run(game, board, train, active_railroad) for route in train_routes]
+        sorted_routes_by_train[train] = sorted(route_values, key=lambda route: route.value, reverse=True)
+
+    train_sets = _routes18xx._get_train_sets(active_railroad)
+    if not train_sets:
+        return RouteSet.create(game, active_railroad, []), True
+
+    train_set_routes = [[sorted_routes_by_train[train] for train in train_set] for train_set in train_sets]
+    train_set_results = _find_best_route_sets(game, active_railroad, train_sets, train_set_routes, processes, deadline, progress)
+    best_route_set = max([route_set for route_set, _ in train_set_results if route_set], default=RouteSet.create(game, active_railroad, []))
+    # Routes that weren't found couldn't be searched, even if the search of the
+    # rest finished.
+    if not found_all_routes or not all(is_finished for _, is_finished in train_set_results):
+        LOG.info("Stopped searching for %s's routes after %ss.", active_railroad.name, time_budget)
+        return best_route_set, False
+
+    # routes18xx.find_best_routes checks the adjusted values of the last train
+    # set's routes.
+    key_func = lambda route: game.hook_route_max_value(route, active_railroad)
+    sorted_routes_by_stops = [sorted(sorted_route_column, key=key_func, reverse=True) for sorted_route_column in train_set_routes[-1]]
+    high_potential_route_sets = _routes18xx._find_high_potential_route_sets(game, active_railroad, best_route_set.value, sorted_routes_by_stops)
+    return max([best_route_set] + high_potential_route_sets, default=RouteSet.create(game, active_railroad, [])), True
@@ -1,16 +1,22 @@
+import time
+
 from flask import abort, g, render_template
 
-from routes18xxweb.games import get_supported_game_info
-from routes18xxweb.logger import get_logger, init_logger, set_log_format
+from routes18xxweb.games import get_board_index, get_supported_game_info, load_snapshot
+from routes18xxweb.logger import get_logger, init_logger, set_sample_rate
 from routes18xxweb.routes18xxweb import app, game_app
 from routes18xx import LOG as LIB_LOG
 
 LOG = get_logger("routes18xxweb")
 init_logger(LOG, "APP_LOG_LEVEL")
-set_log_format(LOG)
+set_sample_rate(LOG, "APP_LOG_SAMPLE_RATE")
+
+# For whole game states and results, which are big enough that logging every
+# one costs more than it's worth.
+PAYLOAD_LOG = get_logger("routes18xxweb.payloads")
+set_sample_rate(PAYLOAD_LOG, "PAYLOAD_LOG_SAMPLE_RATE", 0.1)
 
 init_logger(LIB_LOG, "LIB_LOG_LEVEL", 0)
-set_log_format(LIB_LOG)
 
 GAME_APP_ROOT = "/game"
 UNSUPPORTED_GAME_MESSAGE = "unsupported game"
@@ -34,6 +40,18 @@ def pull_game_name(endpoint, values):
         abort(404, description=UNSUPPORTED_GAME_MESSAGE)
 
 
-from routes18xxweb.views import calculate, game, migrate, report
+from routes18xxweb.views import calculate, game, migrate, monitoring, report
+
+app.register_blueprint(game_app, url_prefix=f"{GAME_APP_ROOT}/<game_name>")
 
-app.register_blueprint(game_app, url_prefix=f"{GAME_APP_ROOT}/<game_name>")
\ No newline at end of file
+# The board index answers the board endpoints with lookups, so load it (and
+# the rest of the game data) from the snapshot, or build it, up front rather
+# than during someone's first click.
+start_time = time.perf_counter()
+if load_snapshot():
+    LOG.info("Loaded the game data snapshot in %.2fs", time.perf_counter() - start_time)
+else:
+    for game_name in get_supported_game_info():
+        start_time = time.perf_counter()
+        get_board_index(game_name)
+        LOG.info("Built the %s board index in %.2fs", game_name, time.perf_counter() - start_time)
\ No newline at end of file
@@ -1,104 +1,462 @@
+import contextlib
 import json
+import os
+import threading
+import time
+import uuid
 
-from flask import g, jsonify, request
-from rq import Queue
+from flask import Response, g, jsonify, request, session, stream_with_context
+from rq import Queue, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.timeouts import JobTimeoutException
 
-from routes18xx import boardstate, find_best_routes, railroads
-
-from routes18xxweb.calculator import redis_conn
-from routes18xxweb.games import get_game
+from routes18xxweb import admission, calculation, costestimate, gamestate, metrics, profiling, resultcache
+from routes18xxweb.calculator import JobCancelled, cancellable, job_events_channel, listen, publish_job_event, redis_conn, request_job_cancel
 from routes18xxweb.routes18xxweb import game_app
-from routes18xxweb.views import LOG
+from routes18xxweb.views import LOG, PAYLOAD_LOG
+
+CALCULATOR_QUEUES = {name: Queue(name, connection=redis_conn) for name in listen}
+
+# Jobs estimated to finish within QUICK_JOB_SECONDS go on the high priority
+# queue, so they don't wait behind long calculations, and jobs estimated to
+# take longer than SLOW_JOB_SECONDS go on the low priority queue.
+QUICK_JOB_SECONDS = float(os.getenv("QUICK_JOB_SECONDS", 5))
+SLOW_JOB_SECONDS = float(os.getenv("SLOW_JOB_SECONDS", 60))
+
+# Jobs get a timeout of JOB_TIMEOUT_FACTOR times their estimated runtime, but
+# never less than the endpoint's usual timeout, or more than MAX_JOB_TIMEOUT.
+JOB_TIMEOUT_FACTOR = 10
+MAX_JOB_TIMEOUT = int(os.getenv("MAX_JOB_TIMEOUT", 30 * 60))
+
+# The longest time budget a user can give a calculation, in seconds. Without
+# one, it runs until it finds the best routes.
+MAX_TIME_BUDGET = int(os.getenv("MAX_CALCULATE_TIME_BUDGET", 5 * 60))
+
+# How long a result stream stays open before the client has to reconnect, and
+# how often it sends something to keep proxies from closing it.
+RESULT_STREAM_TIMEOUT = int(os.getenv("RESULT_STREAM_TIMEOUT", 55))
+RESULT_STREAM_KEEPALIVE = 15
+
+# Each open result stream holds one of the web process's threads, so only this
+# many are streamed at once, leaving the rest for other requests. Past that,
+# clients are turned away and poll for the result instead.
+MAX_RESULT_STREAMS = int(os.getenv("MAX_RESULT_STREAMS", 8))
+_RESULT_STREAMS = threading.BoundedSemaphore(MAX_RESULT_STREAMS)
+
+def _load_request_state():
+    # The client can send only what changed since a state it uploaded before.
+    base_state_id = request.form.get("state-id")
+    if base_state_id:
+        base_state = gamestate.load(g.game_name, base_state_id)
+        if base_state is None:
+            return None, None
+
+        state = gamestate.apply_delta(base_state, json.loads(request.form.get("state-delta-json", "{}")))
+    else:
+        state = {
+            "board": json.loads(request.form.get("board-state-json")),
+            "railroads": json.loads(request.form.get("railroads-json")),
+            "private-companies": json.loads(request.form.get("private-companies-json")),
+            "removed-railroads": json.loads(request.form.get("removed-railroads-json")),
+            "closed-railroads": json.loads(request.form.get("closed-railroads-json"))
+        }
+
+    LOG.info("Base state: %s", base_state_id)
+    PAYLOAD_LOG.info("Private companies: %s", state["private-companies"])
+    PAYLOAD_LOG.info("Railroad input: %s", state["railroads"])
+    PAYLOAD_LOG.info("Removed railroads: %s", state["removed-railroads"])
+    PAYLOAD_LOG.info("Closed railroads: %s", state["closed-railroads"])
+    PAYLOAD_LOG.info("Board input: %s", state["board"])
+
+    return state, gamestate.store(g.game_name, state)
+
+def _unknown_state_response():
+    LOG.info("Calculate request against an unknown game state: %s", request.form.get("state-id"))
+    return jsonify({"error": "Unknown game state.", "stateExpired": True}), 409
+
+# Input the calculation would fail on is turned away before it's queued, with
+# the error the worker would have given.
+def _check_request_state(state, railroads_state_rows, railroad_name=None):
+    try:
+        calculation.check_game_state(g.game_name, railroads_state_rows, state["private-companies"], state["board"], railroad_name)
+    except ValueError as exc:
+        LOG.info("Invalid calculate request: %s", exc)
+        metrics.increment("calculate-invalid")
+        return jsonify({"error": {"message": f"An error occurred during route calculation: {exc}"}}), 400
+    return None
+
+def _get_queue(estimated_runtime):
+    if estimated_runtime <= QUICK_JOB_SECONDS:
+        return CALCULATOR_QUEUES["high"]
+    elif estimated_runtime > SLOW_JOB_SECONDS:
+        return CALCULATOR_QUEUES["low"]
+    else:
+        return CALCULATOR_QUEUES["default"]
+
+def _get_job_timeout(estimated_runtime, min_timeout):
+    return int(max(min(estimated_runtime * JOB_TIMEOUT_FACTOR, MAX_JOB_TIMEOUT), min_timeout))
+
+def _get_client_id():
+    if "client-id" not in session:
+        session["client-id"] = uuid.uuid4().hex
+    return session["client-id"]
+
+# The time budget the user gave the calculation, if any, in seconds.
+def _get_time_budget():
+    time_budget = request.form.get("time-budget", type=float)
+    return min(time_budget, MAX_TIME_BUDGET) if time_budget and time_budget > 0 else None
+
+def _get_client_ip():
+    # The router appends the address it saw to any X-Forwarded-For the client
+    # sent, so the last one can be trusted.
+    return request.access_route[-1]
+
+# A job can be reused from the cache unless reuse is False, in which case a new
+# one always runs (e.g. to profile it).
+def _enqueue_cached(request_key, estimated_runtime, min_timeout, func, *args, reuse=True):
+    client_id = _get_client_id()
+    client_ip = _get_client_ip()
+
+    job = resultcache.get_job(request_key) if reuse else None
 
-CALCULATOR_QUEUE = Queue(connection=redis_conn)
+    # A new submission replaces the client's calculations still waiting for a worker.
+    for queued_job in admission.get_queued_jobs(client_id):
+        if not job or queued_job.id != job.id:
+            LOG.info("Replacing queued calculation job %s", queued_job.id)
+            _cancel_job(queued_job, client_id)
+            admission.untrack(client_id, client_ip, queued_job.id)
+            metrics.increment("admission-replaced")
+
+    if job:
+        LOG.info("Reusing calculation job %s for request %s", job.id, request_key)
+    else:
+        admission.check(client_id, client_ip)
+
+        queue = _get_queue(estimated_runtime)
+        job_timeout = _get_job_timeout(estimated_runtime, min_timeout)
+        LOG.info("Estimated runtime: %.3fs. Queue: %s. Timeout: %ss", estimated_runtime, queue.name, job_timeout)
+
+        job = queue.enqueue(func, *args, job_timeout=job_timeout, result_ttl=resultcache.CACHE_TTL,
+                meta={"estimated-runtime": estimated_runtime})
+        resultcache.put_job(request_key, job.id)
+    resultcache.add_waiter(job.id, client_id)
+    admission.track(client_id, client_ip, job.id)
+    return job
+
+@game_app.errorhandler(admission.Rejected)
+def calculate_rejected(exc):
+    LOG.info("Calculate request rejected: %s", exc)
+    return jsonify({"error": str(exc), "retryAfter": exc.retry_after}), exc.status_code, {"Retry-After": str(exc.retry_after)}
+
+# Jobs can be on any of the queues, so they're fetched directly.
+def _fetch_job(job_id):
+    try:
+        return Job.fetch(job_id, connection=redis_conn)
+    except NoSuchJobError:
+        return None
 
 @game_app.route("/calculate", methods=["POST"])
 def calculate():
-    railroads_state_rows = json.loads(request.form.get("railroads-json"))
-    removed_railroads = json.loads(request.form.get("removed-railroads-json"))
-    closed_railroads = json.loads(request.form.get("closed-railroads-json"))
-    private_companies_rows = json.loads(request.form.get("private-companies-json"))
-    board_state_rows = json.loads(request.form.get("board-state-json"))
+    LOG.info("Calculate request.")
+
     railroad_name = request.form["railroad-name"]
+    LOG.info("Target railroad: %s", railroad_name)
 
-    LOG.info("Calculate request.")
-    LOG.info(f"Target railroad: {railroad_name}")
-    LOG.info(f"Private companies: {private_companies_rows}")
-    LOG.info(f"Railroad input: {railroads_state_rows}")
-    LOG.info(f"Removed railroads: {removed_railroads}")
-    LOG.info(f"Closed railroads: {closed_railroads}")
-    LOG.info(f"Board input: {board_state_rows}")
+    state, state_id = _load_request_state()
+    if state is None:
+        return _unknown_state_response()
+    LOG.info("State: %s", state_id)
+
+    time_budget = _get_time_budget()
+    LOG.info("Time budget: %s", time_budget)
 
-    railroads_state_rows += [[name, "removed"] for name in removed_railroads]
-    railroads_state_rows += [[name, "closed"] for name in closed_railroads]
+    railroads_state_rows = gamestate.railroads_state_rows(state)
+    invalid_response = _check_request_state(state, railroads_state_rows, railroad_name)
+    if invalid_response:
+        return invalid_response
 
-    job = CALCULATOR_QUEUE.enqueue(calculate_worker, g.game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name, job_timeout="5m")
+    estimated_runtime = costestimate.estimate(g.game_name, railroads_state_rows, state["board"], railroad_name)
+    if time_budget:
+        estimated_runtime = min(estimated_runtime, time_budget)
+    # An admin asking for a profile wants this calculation profiled, not the
+    # cached one.
+    profile_token = request.form.get("profile-token")
+    profile = profiling.should_profile(profile_token)
 
-    return jsonify({"jobId": job.id})
+    job = _enqueue_cached(resultcache.request_key(g.game_name, state_id, railroad_name, time_budget), estimated_runtime, 5 * 60,
+            calculate_worker, g.game_name, railroads_state_rows, state["private-companies"], state["board"], railroad_name, time_budget, profile,
+            reuse=not profiling.is_admin_request(profile_token))
+
+    return jsonify({"jobId": job.id, "stateId": state_id})
+
+@game_app.route("/calculate/all", methods=["POST"])
+def calculate_all():
+    LOG.info("Calculate all railroads request.")
+
+    state, state_id = _load_request_state()
+    if state is None:
+        return _unknown_state_response()
+    LOG.info("State: %s", state_id)
+
+    railroads_state_rows = gamestate.railroads_state_rows(state)
+    invalid_response = _check_request_state(state, railroads_state_rows)
+    if invalid_response:
+        return invalid_response
+
+    estimated_runtime = costestimate.estimate_all(g.game_name, railroads_state_rows, state["board"], calculation.CALCULATE_ALL_PROCESSES)
+    # No railroad name marks the request as a batch in the cache key.
+    job = _enqueue_cached(resultcache.request_key(g.game_name, state_id, None), estimated_runtime, 15 * 60,
+            calculate_all_worker, g.game_name, railroads_state_rows, state["private-companies"], state["board"])
+
+    return jsonify({"jobId": job.id, "stateId": state_id})
+
+# Returns the result JSON for the job, and whether the job is done. A finished
+# job's result was stored by the worker as JSON, so it's handed back as is.
+def _get_result_json(job_id, get_progress):
+    result = resultcache.get_result(job_id)
+    if result is not None:
+        return result.decode("utf-8"), True
+
+    progress_json = get_progress(job_id)
+    return json.dumps(progress_json), "jobId" not in progress_json
 
 @game_app.route("/calculate/result")
 def calculate_result():
-    routes_json = get_calculate_result(request.args.get("jobId"))
+    result_json, _ = _get_result_json(request.args.get("jobId"), _get_calculate_progress)
+
+    PAYLOAD_LOG.info("Calculate response: %s", result_json)
 
-    LOG.info(f"Calculate response: {routes_json}")
+    return Response(result_json, mimetype="application/json")
 
-    return jsonify(routes_json)
+@game_app.route("/calculate/all/result")
+def calculate_all_result():
+    result_json, _ = _get_result_json(request.args.get("jobId"), _get_calculate_all_progress)
+
+    PAYLOAD_LOG.info("Calculate all railroads response: %s", result_json)
+
+    return Response(result_json, mimetype="application/json")
+
+def _stream_result(job_id, get_progress):
+    pubsub = redis_conn.pubsub(ignore_subscribe_messages=True)
+    # Subscribe before checking on the job, so an event published in between
+    # isn't missed.
+    pubsub.subscribe(job_events_channel(job_id))
+    try:
+        result_json, is_done = _get_result_json(job_id, get_progress)
+        yield f"data: {result_json}\n\n"
+
+        deadline = time.monotonic() + RESULT_STREAM_TIMEOUT
+        while not is_done and time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=min(RESULT_STREAM_KEEPALIVE, max(deadline - time.monotonic(), 0)))
+            if message:
+                result_json, is_done = _get_result_json(job_id, get_progress)
+                yield f"data: {result_json}\n\n"
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        pubsub.close()
+
+def _result_stream_response(job_id, get_progress):
+    if not _RESULT_STREAMS.acquire(blocking=False):
+        metrics.increment("result-streams-rejected")
+        return jsonify({"error": "Too many result streams open. Poll for the result instead."}), 503
+
+    response = Response(stream_with_context(_stream_result(job_id, get_progress)), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # The server closes the response even if the client leaves before it's
+    # streamed anything.
+    response.call_on_close(_RESULT_STREAMS.release)
+    return response
+
+# Pushes the result as soon as the job is done, instead of the client polling
+# for it. Each event carries the same JSON the corresponding result endpoint
+# returns. The stream closes once the job is done, or after
+# RESULT_STREAM_TIMEOUT seconds, in which case the client reconnects.
+@game_app.route("/calculate/result/stream")
+def calculate_result_stream():
+    return _result_stream_response(request.args.get("jobId"), _get_calculate_progress)
+
+@game_app.route("/calculate/all/result/stream")
+def calculate_all_result_stream():
+    return _result_stream_response(request.args.get("jobId"), _get_calculate_all_progress)
+
+@game_app.route("/calculate/profile")
+def calculate_profile():
+    # Profiles show the server's code and the calculation's board, so only
+    # admins can read them. The token can go in a header to keep it out of
+    # access logs, or in the query string for a browser.
+    profile_token = request.headers.get("X-Profile-Token") or request.args.get("profile-token")
+    if not profiling.is_admin_request(profile_token):
+        return jsonify({"error": "A valid profile token is required."}), 403
+
+    job_id = request.args.get("jobId")
+
+    if request.args.get("format") == "stats":
+        stats = profiling.get_stats(job_id)
+        if stats is None:
+            return jsonify({"error": "No profile found for the job."}), 404
+        return Response(stats, mimetype="application/octet-stream", headers={"Content-Disposition": f"attachment; filename={job_id}.prof"})
+
+    sort_key = request.args.get("sort", "cumulative")
+    if sort_key not in profiling.SUMMARY_SORT_KEYS:
+        sort_key = "cumulative"
+    limit = min(max(request.args.get("limit", 30, type=int), 1), profiling.MAX_SUMMARY_LIMIT)
+    summary = profiling.get_summary(job_id, limit, sort_key)
+    if summary is None:
+        return jsonify({"error": "No profile found for the job."}), 404
+    return Response(summary, mimetype="text/plain")
 
 @game_app.route("/calculate/cancel", methods=["POST"])
 def cancel_calculate_request():
     job_id = request.form.get("jobId")
 
-    job = CALCULATOR_QUEUE.fetch_job(job_id)
+    job = _fetch_job(job_id)
     if job:
-        job.delete()
+        _cancel_job(job, _get_client_id())
     return jsonify({})
 
-def get_calculate_result(job_id):
+def _cancel_job(job, client_id):
+    # A finished job is kept around as a cached result, and a job other
+    # clients are still waiting on must keep running.
+    if not job.is_finished and resultcache.remove_waiter(job.id, client_id) == 0:
+        # The flag also catches a job that starts before it's deleted.
+        request_job_cancel(job.id)
+        if job.is_started:
+            # The worker deletes the job once it's stopped it.
+            metrics.increment("calculate-cancelled-running")
+        else:
+            job.delete()
+            metrics.increment("calculate-cancelled-queued")
+
+def _get_job_error(job):
+    exc_info = json.loads(job.exc_info)
+    return {
+        "message": f"An error occurred during route calculation: {exc_info['message']}",
+        "traceback": exc_info["traceback"]
+    }
+
+# The result JSON for a job without a stored result: one that's in progress,
+# failed, or unknown. The job's status is the one it was fetched with, so the
+# asyncio endpoints can fetch it themselves.
+def calculate_progress(job_id, job):
     routes_json = {}
 
-    job = CALCULATOR_QUEUE.fetch_job(job_id)
     # If job is None, it means the job ID couldn't be found, either because it's invalid, or the job was cancelled.
     if job:
-        if job.is_failed:
+        status = job.get_status(refresh=False)
+        if status == JobStatus.FAILED:
             # The job experienced an error
             if not job.exc_info:
                 # The error info hasn't propagated yet, so act as if the job is still in progress
                 routes_json["jobId"] = job_id
             else:
-                exc_info = json.loads(job.exc_info)
-                routes_json["error"] = {
-                    "message": f"An error occurred during route calculation: {exc_info['message']}",
-                    "traceback": exc_info["traceback"]
-                }
-
-        elif job.is_finished:
-            routes_json["routes"] = []
-            for route in job.result:
-                routes_json["routes"].append([
-                    str(route.train),
-                    [str(space.cell) for space in route],
-                    route.value,
-                    [(stop.name, route.stop_values[stop]) for stop in route.visited_stops]
-                ])
-        else:
-            # The job is in progress
+                routes_json["error"] = _get_job_error(job)
+
+        elif status != JobStatus.FINISHED:
+            # The job is in progress. Once it's searching, it reports the best
+            # routes it's found so far. Before then, it reports how many of
+            # the trains' routes it's found.
             routes_json["jobId"] = job_id
+            if "routes" in job.meta:
+                routes_json["routes"] = job.meta["routes"]
+            if "progress" in job.meta:
+                routes_json["progress"] = job.meta["progress"]
 
     return routes_json
 
-def calculate_worker(game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name):
-    game = get_game(game_name)
-    board_state = boardstate.load(game, [dict(zip(boardstate.FIELDNAMES, row)) for row in board_state_rows if any(val for val in row)])
-    railroad_dict = railroads.load(game, board_state, [dict(zip(railroads.FIELDNAMES, row)) for row in railroads_state_rows if any(val for val in row)])
-    game.capture_phase(railroad_dict)
+def calculate_all_progress(job_id, job):
+    routes_json = {}
+
+    if job:
+        status = job.get_status(refresh=False)
+        if status == JobStatus.FAILED:
+            if not job.exc_info:
+                routes_json["jobId"] = job_id
+            else:
+                routes_json["error"] = _get_job_error(job)
+        elif status != JobStatus.FINISHED:
+            # Railroads are reported as they finish, so partial results are
+            # returned while the job is in progress.
+            railroads_json = job.meta.get("results", {})
+            routes_json["railroads"] = railroads_json
+            routes_json["pending"] = [name for name in job.meta.get("railroads", []) if name not in railroads_json]
+            routes_json["jobId"] = job_id
+
+    return routes_json
+
+def _get_calculate_progress(job_id):
+    return calculate_progress(job_id, _fetch_job(job_id))
+
+def _get_calculate_all_progress(job_id):
+    return calculate_all_progress(job_id, _fetch_job(job_id))
+
+def get_calculate_result(job_id):
+    return json.loads(_get_result_json(job_id, _get_calculate_progress)[0])
+
+# Records how long the job waited in its queue and ran, and how it ended.
+@contextlib.contextmanager
+def _recorded_job(job, game_name):
+    labels = {"game": game_name, "queue": job.origin}
+    if job.enqueued_at and job.started_at:
+        metrics.observe("calculate-job-wait-seconds", (job.started_at - job.enqueued_at).total_seconds(), labels)
+
+    status = "failed"
+    start_time = time.perf_counter()
+    try:
+        yield
+        status = "finished"
+    except JobCancelled:
+        status = "cancelled"
+        raise
+    except JobTimeoutException:
+        status = "timeout"
+        raise
+    finally:
+        metrics.observe("calculate-job-runtime-seconds", time.perf_counter() - start_time, labels)
+        metrics.increment("calculate-jobs", labels={**labels, "status": status})
+        metrics.flush_cache_stats(force=True)
+        metrics.set_gauge("board-state-cache-size", calculation.get_board_state_cache_size(), {"process": metrics.PROCESS_NAME})
+
+# Workers store the result as the JSON the result endpoints return, rather than
+# returning it for rq to pickle, so answering a poll doesn't need routes18xx.
+def calculate_worker(game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name, time_budget=None, profile=False):
+    job = get_current_job()
+
+    # Until the search has routes, it only reports how many it's found.
+    def save_progress(routes, progress):
+        if routes is not None:
+            job.meta["routes"] = calculation.routes_to_json(routes)
+        job.meta["progress"] = round(progress, 3)
+        job.save_meta()
+        publish_job_event(job.id, "progress")
+
+    # A profile only sees its own process, so a profiled job searches in one.
+    profiler = profiling.profiled(job.id) if profile else contextlib.nullcontext()
+    with _recorded_job(job, game_name), cancellable(job), profiler:
+        routes, is_optimal = calculation.calculate(game_name, railroads_state_rows, private_companies_rows, board_state_rows, railroad_name,
+                time_budget, save_progress, 1 if profile else None)
+    # Routes found within the time budget aren't necessarily the best.
+    resultcache.save_result(job.id, {"routes": calculation.routes_to_json(routes), "optimal": is_optimal})
+
+def calculate_all_worker(game_name, railroads_state_rows, private_companies_rows, board_state_rows):
+    job = get_current_job()
+
+    def save_result(railroad_name, result):
+        job.meta["results"][railroad_name] = result
+        job.save_meta()
+        publish_job_event(job.id, "progress")
 
-    private_companies = game.get_game_submodule("private_companies")
-    if private_companies:
-        private_companies.load(game, board_state, railroad_dict, [dict(zip(private_companies.FIELDNAMES, row)) for row in private_companies_rows if any(val for val in row)])
-    board_state.validate()
+    with _recorded_job(job, game_name):
+        game_state = calculation.load_game_state(game_name, railroads_state_rows, private_companies_rows, board_state_rows)
+        railroad_names = calculation.get_operating_railroads(game_state[2])
 
-    if railroad_name not in railroad_dict:
-        valid_railroads = ", ".join(railroad_dict.keys())
-        raise ValueError(f"Railroad chosen: \"{railroad_name}\". Valid railroads: {valid_railroads}")
+        job.meta["railroads"] = railroad_names
+        job.meta["results"] = {}
+        job.save_meta()
 
-    return find_best_routes(game, board_state, railroad_dict, railroad_dict[railroad_name])
+        with cancellable(job):
+            results = calculation.calculate_all(game_state, railroad_names, save_result)
+    resultcache.save_result(job.id, {"railroads": results, "pending": []})
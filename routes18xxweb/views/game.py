@@ -2,16 +2,18 @@ import math
 import json
 import os
 
-from flask import g, jsonify, redirect, render_template, request, session, url_for
+from flask import abort, g, jsonify, redirect, render_template, request, send_from_directory, session, url_for
 
 from routes18xx import boardstate, boardtile, placedtile, railroads, tiles, trains as trains_mod
 
+from routes18xxweb import boardindex
+from routes18xxweb.httpcache import cached_game_response
 from routes18xxweb.views import GAME_APP_ROOT, LOG, migrate
 from routes18xxweb.routes18xxweb import app, game_app
 from routes18xxweb.calculator import redis_conn
-from routes18xxweb.games import (get_board, get_board_layout, get_game, \
-    get_private_offsets, get_railroad_info, get_station_offsets, \
-    get_supported_game_info, get_termini_boundaries, get_train_info)
+from routes18xxweb.games import (get_board, get_board_index, get_board_layout, \
+    get_game, get_private_offsets, get_railroad_info, get_station_offsets, \
+    get_supported_game_info, get_termini_boundaries, get_tile_atlas, get_train_info, TILE_ATLAS_DIR)
 
 
 RAILROADS_COLUMN_MAP = {
@@ -35,14 +37,17 @@ PLACED_TILES_COLUMN_MAP = {
 RAILROADS_COLUMN_NAMES = [RAILROADS_COLUMN_MAP[colname] for colname in railroads.FIELDNAMES]
 PLACED_TILES_COLUMN_NAMES = [PLACED_TILES_COLUMN_MAP[colname] for colname in boardstate.FIELDNAMES]
 
+# Bump this when the layout of the bootstrap document changes.
+BOOTSTRAP_VERSION = 1
+
+_BOOTSTRAPS = {}
+
+# Tile atlas image names change with their content, so they never go stale.
+# Only the images are served: the indexes keep their names, and the page has
+# its game's sprites already.
+TILE_ATLAS_MAX_AGE = 365 * 24 * 60 * 60
+TILE_ATLAS_IMAGE_EXTENSIONS = (".webp", ".png")
 
-def get_tile_coords(board):
-    tile_coords = []
-    for cell in board.cells:
-        space = board.get_space(cell)
-        if not space or space.is_city or space.upgrade_level is not None:
-            tile_coords.append(str(cell))
-    return tile_coords
 
 def _get_board_layout_info():
     board = get_board(g.game_name)
@@ -68,11 +73,29 @@ def game_picker():
 def incomplete_game_url_handler():
     return redirect(url_for("game_picker"))
 
-@game_app.route("/")
-def main():
-    migration_data = migrate.process_migrate_data()
+@app.route("/tile-atlases/<filename>")
+def tile_atlas(filename):
+    if os.path.splitext(filename)[1] not in TILE_ATLAS_IMAGE_EXTENSIONS:
+        abort(404)
+
+    response = send_from_directory(TILE_ATLAS_DIR, filename, max_age=TILE_ATLAS_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def _get_tile_atlas_info(game_name):
+    tile_atlas = get_tile_atlas(game_name)
+    return {
+        "webp": url_for("tile_atlas", filename=tile_atlas["webp"]),
+        "png": url_for("tile_atlas", filename=tile_atlas["png"]),
+        "sprites": tile_atlas["sprites"]
+    }
 
-    game = get_game(g.game_name)
+def _get_home_cities(railroad_names):
+    railroads_info = get_railroad_info(g.game_name)
+    return {railroad: railroads_info[railroad]["home"] for railroad in railroad_names}
+
+def _get_stop_names(game):
     board = get_board(game)
 
     stop_names = {}
@@ -80,8 +103,46 @@ def main():
         space = board.get_space(cell)
         if space and space.is_stop:
             stop_names[str(cell)] = space.nickname
+    return stop_names
+
+def _build_bootstrap(game):
+    board_index = get_board_index(game)
+    train_info = get_train_info(game)
+    private_companies = game.get_game_submodule("private_companies")
+
+    return {
+        "version": BOOTSTRAP_VERSION,
+        "stop-names": _get_stop_names(game),
+        "termini-boundaries": {name: info["boundaries"] for name, info in get_termini_boundaries(game).items()},
+        "cities": list(board_index.cities),
+        "split-cities": list(board_index.split_cities),
+        "trains": [str(train) for train in sorted(train_info, key=lambda train: (train.collect, train.visit))],
+        # Enough for the client to work out the phase from the trains
+        # railroads own, the same as _phase_from_trains.
+        "phases": list(game.phases),
+        "train-phases": {str(train): train.phase for train in train_info},
+        "railroads": sorted(get_railroad_info(game).keys()),
+        "removable-railroads": sorted(_get_removable_railroads()),
+        "closable-railroads": sorted(_get_closable_railroads(game)),
+        "home-cities": _get_home_cities(get_railroad_info(game).keys()),
+        "private-company-coords": private_companies.PRIVATE_COMPANY_COORDS if private_companies else {},
+        "open-private-companies": {phase: [private_company for private_company in private_companies.COMPANIES if not game.private_is_closed(private_company, phase)]
+                for phase in game.phases} if private_companies else {}
+    }
+
+# Everything the page's tables need that's the same for every game state,
+# so they have it once the page loads, instead of asking for it piece by
+# piece.
+def get_bootstrap(game):
+    if game.name not in _BOOTSTRAPS:
+        _BOOTSTRAPS[game.name] = _build_bootstrap(game)
+    return _BOOTSTRAPS[game.name]
+
+@game_app.route("/")
+def main():
+    migration_data = migrate.process_migrate_data()
 
-    termini_boundaries = {name: info["boundaries"] for name, info in get_termini_boundaries(game).items()}
+    game = get_game(g.game_name)
 
     private_companies = game.get_game_submodule("private_companies")
     private_company_names = private_companies.COMPANIES.keys() if private_companies else []
@@ -91,41 +152,29 @@ def main():
             private_company_default_token_coords=private_companies.PRIVATE_COMPANY_DEFAULT_COORDS if private_companies else {},
             private_company_rownames=private_company_names,
             placed_tiles_colnames=PLACED_TILES_COLUMN_NAMES,
-            tile_coords=get_tile_coords(board),
-            stop_names=stop_names,
-            termini_boundaries=termini_boundaries,
+            tile_coords=get_board_index(game).tile_coords,
+            bootstrap=get_bootstrap(game),
+            tile_atlas=_get_tile_atlas_info(g.game_name),
             removable_railroads=_get_removable_railroads(),
             closable_railroads=_get_closable_railroads(game),
             board_layout=_get_board_layout_info(),
             migration_data=migration_data)
 
-def _legal_tile_ids_by_coord(game, coord):
-    board = get_board(game)
-    space = board.get_space(board.cell(coord))
-    # If the coord is a built-in upgrade level 4 tile
-    if space and space.upgrade_level is None:
-        return []
-
-    legal_tile_ids = []
-    for tile in game.tiles.values():
-        if not space:
-            if tile.is_stop:
-                continue
-        elif tile.upgrade_level <= space.upgrade_level:
-            continue
-        elif space.is_city != tile.is_city or space.is_town != tile.is_town or tile.upgrade_attrs not in space.upgrade_attrs:
-            continue
-
-        legal_orientations, _ = _get_orientations(game, coord, tile.id)
-        if legal_orientations:
-            legal_tile_ids.append(tile.id)
-
-    return legal_tile_ids
+@game_app.route("/bootstrap")
+@cached_game_response
+def bootstrap():
+    return jsonify(get_bootstrap(get_game(g.game_name)))
 
 def _get_orientations(game, coord, tile_id):
     if not coord or not tile_id:
         return None, None
 
+    orientations = get_board_index(game).orientations.get(coord, {}).get(tile_id)
+    if orientations is not None:
+        return list(orientations[0]), orientations[1]
+
+    # Anything outside the index (e.g. a tile that isn't an upgrade of the
+    # space) is checked the slow way.
     board = get_board(game)
 
     try:
@@ -137,71 +186,50 @@ def _get_orientations(game, coord, tile_id):
     if not tile:
         return None, None
 
-    all_paths = {}
-    orientations = []
-    translations = {}
-    for orientation in range(0, 6):
-        try:
-            board._validate_place_tile_neighbors(cell, tile, orientation)
-            board._validate_place_tile_upgrade(board.get_space(cell), cell, tile, orientation)
-        except ValueError:
-            continue
-
-        tile_paths = tuple(sorted((key, tuple(sorted(val))) for key, val in placedtile.PlacedTile.get_paths(cell, tile, orientation).items()))
-        if tile_paths in all_paths:
-            translations[orientation] = all_paths[tile_paths]
-            continue
-
-        orientations.append(orientation)
-        all_paths[tile_paths] = orientation
-
-    return orientations, translations
+    return boardindex.get_orientations(board, cell, tile)
 
 @game_app.route("/board/tile-coords")
+@cached_game_response
 def legal_tile_coords():
     LOG.info("Legal tile coordinates request.")
 
     current_coord = request.args.get("coord")
     existing_tile_coords = {coord for coord in json.loads(request.args.get("tile_coords")) if coord}
 
-    legal_tile_coordinates = set(get_tile_coords(get_board(g.game_name))) - existing_tile_coords
+    legal_tile_coordinates = set(get_board_index(g.game_name).tile_coords) - existing_tile_coords
     if current_coord:
         legal_tile_coordinates.add(current_coord)
 
-    LOG.info(f"Legal tile coordinates response: {legal_tile_coordinates}")
+    LOG.info("Legal tile coordinates response: %s", legal_tile_coordinates)
 
     return jsonify({"tile-coords": list(sorted(legal_tile_coordinates))})
 
-@game_app.route("/board/tile-image")
-def board_tile_image():
-    tile_id = request.args.get("tileId")
-    return url_for('static', filename='images/tiles/{:03}'.format(tile_id))
-
 @game_app.route("/board/legal-tiles")
+@cached_game_response
 def legal_tiles():
     game = get_game(g.game_name)
 
     coord = request.args.get("coord")
 
-    LOG.info(f"Legal tiles request for {coord}.")
+    LOG.info("Legal tiles request for %s.", coord)
 
-    legal_tile_ids = _legal_tile_ids_by_coord(get_game(g.game_name), coord)
-    legal_tile_ids.sort(key=lambda tile_id: f"{game.tiles[tile_id].upgrade_level}-{tile_id:0>3}")
+    legal_tile_ids = list(get_board_index(game).legal_tiles.get(coord, []))
 
-    LOG.info(f"Legal tiles response for {coord}: {legal_tile_ids}")
+    LOG.info("Legal tiles response for %s: %s", coord, legal_tile_ids)
 
     return jsonify({"legal-tile-ids": legal_tile_ids})
 
 @game_app.route("/board/legal-orientations")
+@cached_game_response
 def legal_orientations():
     coord = request.args.get("coord")
     tile_id = request.args.get("tileId")
 
-    LOG.info(f"Legal orientations request for {tile_id} at {coord}.")
+    LOG.info("Legal orientations request for %s at %s.", tile_id, coord)
 
     orientations, translations = _get_orientations(get_game(g.game_name), coord, tile_id)
 
-    LOG.info(f"Legal orientations response for {tile_id} at {coord}: {orientations}")
+    LOG.info("Legal orientations response for %s at %s: %s", tile_id, coord, orientations)
 
     return jsonify({
         "legal-orientations": list(sorted(orientations)) if orientations is not None else orientations,
@@ -218,6 +246,7 @@ def _get_station_offset(offset_data, key):
         return space_offset_data.get("offset", default_offset).copy()
 
 @game_app.route("/board/space-info")
+@cached_game_response
 def board_space_info():
     coord = request.args["coord"].strip()
     tile_id = request.args.get("tileId", "").strip()
@@ -275,6 +304,7 @@ def board_space_info():
     return jsonify({"info": info})
 
 @game_app.route("/board/private-company-info")
+@cached_game_response
 def board_private_company_info():
     coord = request.args.get("coord")
     company = request.args.get("company")
@@ -305,12 +335,13 @@ def board_private_company_info():
     return jsonify({"info": info})
 
 @game_app.route("/board/phase")
+@cached_game_response
 def board_phase():
     LOG.info("Phase request")
 
     phase = _phase_from_trains(request.args.get("trains"))
 
-    LOG.info(f"Phase: {phase}")
+    LOG.info("Phase: %s", phase)
 
     return jsonify({"phase": phase})
 
@@ -323,19 +354,19 @@ def _phase_from_trains(train_strs_json):
         return get_game(g.game_name).phases[0]
 
 @game_app.route("/railroads/legal-railroads")
+@cached_game_response
 def legal_railroads():
     LOG.info("Legal railroads request.")
 
     existing_railroads = {railroad for railroad in json.loads(request.args.get("railroads", "{}")) if railroad}
 
-    railroads_info = get_railroad_info(g.game_name)
-    legal_railroads = set(railroads_info.keys()) - existing_railroads
+    legal_railroads = set(get_railroad_info(g.game_name).keys()) - existing_railroads
 
-    LOG.info(f"Legal railroads response: {legal_railroads}")
+    LOG.info("Legal railroads response: %s", legal_railroads)
 
     return jsonify({
         "railroads": list(sorted(legal_railroads)),
-        "home-cities": {railroad: railroads_info[railroad]["home"] for railroad in legal_railroads}
+        "home-cities": _get_home_cities(legal_railroads)
     })
 
 def _get_removable_railroads():
@@ -343,65 +374,59 @@ def _get_removable_railroads():
     return {name for name, attribs in railroads_info.items() if attribs.get("is_removable")}
 
 @game_app.route("/railroads/removable-railroads")
+@cached_game_response
 def removable_railroads():
     LOG.info("Removable railroads request.")
 
     removable_railroads = _get_removable_railroads()
 
-    LOG.info(f"Removable railroads response: {removable_railroads}")
+    LOG.info("Removable railroads response: %s", removable_railroads)
 
-    railroads_info = get_railroad_info(g.game_name)
     return jsonify({
         "railroads": list(sorted(removable_railroads)),
-        "home-cities": {railroad: railroads_info[railroad]["home"] for railroad in removable_railroads}
+        "home-cities": _get_home_cities(removable_railroads)
     })
 
 def _get_closable_railroads(game):
     return set(get_railroad_info(game).keys()) if game.rules.railroads_can_close else set()
  
 @game_app.route("/railroads/closable-railroads")
+@cached_game_response
 def closable_railroads():
     LOG.info("Closable railroads request.")
 
     game = get_game(g.game_name)
     closable_railroads = _get_closable_railroads(game)
 
-    LOG.info(f"Closable railroads response: {closable_railroads}")
+    LOG.info("Closable railroads response: %s", closable_railroads)
 
-    railroads_info = get_railroad_info(game)
     return jsonify({
         "railroads": list(sorted(closable_railroads)),
-        "home-cities": {railroad: railroads_info[railroad]["home"] for railroad in closable_railroads}
+        "home-cities": _get_home_cities(closable_railroads)
     })
 
 @game_app.route("/railroads/trains")
+@cached_game_response
 def trains():
     LOG.info("Train request.")
 
     all_trains = get_train_info(g.game_name)
     train_strs = [str(train) for train in sorted(all_trains, key=lambda train: (train.collect, train.visit))]
 
-    LOG.info(f"Train response: {all_trains}")
+    LOG.info("Train response: %s", all_trains)
 
     return jsonify({"trains": train_strs})
 
 @game_app.route("/railroads/cities")
+@cached_game_response
 def cities():
     LOG.info("Cities request.")
 
-    board = get_board(g.game_name)
-    # all_cities = [str(cell) for cell in sorted(board.cells) if board.get_space(cell) and board.get_space(cell).is_city]
-    all_cities = []
-    split_cities = []
-    for cell in sorted(board.cells):
-        space = board.get_space(cell)
-        if space and space.is_city:
-            coord = str(cell)
-            all_cities.append(coord)
-            if isinstance(space, (boardtile.SplitCity, placedtile.SplitCity)):
-                split_cities.append(coord)
+    board_index = get_board_index(g.game_name)
+    all_cities = list(board_index.cities)
+    split_cities = list(board_index.split_cities)
 
-    LOG.info(f"Cities response: {all_cities}")
+    LOG.info("Cities response: %s", all_cities)
 
     return jsonify({
         "cities": all_cities,
@@ -409,6 +434,7 @@ def cities():
     })
 
 @game_app.route("/railroads/legal-split-city-stations")
+@cached_game_response
 def split_city_stations():
     LOG.info("Legal split city stations request.")
 
@@ -424,12 +450,18 @@ def split_city_stations():
 
     legal_stations = sorted(split_city_station_coords - existing_station_coords)
 
-    LOG.info(f"Legal split city stations response: {legal_stations}")
+    LOG.info("Legal split city stations response: %s", legal_stations)
 
     return jsonify({"split-city-stations": legal_stations})
 
 def _get_split_city_stations(coord, tile_id, orientation):
     game = get_game(g.game_name)
+
+    index_key = (coord, tile_id, int(orientation)) if tile_id and orientation else (coord, None, None)
+    split_city_station_coords = get_board_index(game).split_city_stations.get(index_key)
+    if split_city_station_coords is not None:
+        return split_city_station_coords
+
     board = get_board(game)
     cell = board.cell(coord)
 
@@ -438,18 +470,10 @@ def _get_split_city_stations(coord, tile_id, orientation):
     else:
         split_city_space = board.get_space(cell)
 
-    split_city_station_coords = set()
-    for branch in split_city_space.capacity.keys():
-        unique_exit_coords = [branch_key for branch_key in branch if len(branch_key) == 1]
-        if unique_exit_coords:
-            # A unique exit coord is a sequence of length 1, so we need to extract it
-            split_city_station_coords.add(str(sorted(unique_exit_coords)[0][0]))
-        else:
-            split_city_station_coords.add(str(sorted(branch)[0]))
-
-    return split_city_station_coords
+    return boardindex.get_split_city_stations(split_city_space)
 
 @game_app.route("/railroads/legal-token-coords")
+@cached_game_response
 def legal_token_coords():
     game = get_game(g.game_name)
     private_companies = game.get_game_submodule("private_companies")
@@ -460,11 +484,12 @@ def legal_token_coords():
 
     private_company_coords = private_companies.PRIVATE_COMPANY_COORDS
 
-    LOG.info(f"Legal private company token coordinates response: {private_company_coords}")
+    LOG.info("Legal private company token coordinates response: %s", private_company_coords)
 
     return jsonify({"coords": private_company_coords})
 
 @game_app.route("/private-comapnies/open")
+@cached_game_response
 def private_companies_open():
     game = get_game(g.game_name)
     private_companies = game.get_game_submodule("private_companies")
@@ -476,6 +501,6 @@ def private_companies_open():
     phase = _phase_from_trains(request.args.get("trains"))
     private_companies = [private_company for private_company in private_companies.COMPANIES if not game.private_is_closed(private_company, phase)]
 
-    LOG.info(f"Open private companies response: {private_companies}")
+    LOG.info("Open private companies response: %s", private_companies)
 
     return jsonify({"private-companies": private_companies})
\ No newline at end of file
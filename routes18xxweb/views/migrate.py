@@ -10,93 +10,117 @@ from routes18xxweb.views import LOG
 
 REDIS_KEY_PREFIX = "migrate"
 SESSION_COOKIE_KEY = "migration_data"
+MIGRATION_TTL = 60
+MIGRATION_START_ERROR = {"error": "Failed to start the migration."}
 
-@game_app.route("/migrate/start", methods=["POST"])
-@csrf.exempt
-def start_migration():
+def migration_key(id):
+    return f"{REDIS_KEY_PREFIX}-{id}"
+
+# Returns the migration data in the request body, or None if it's not valid.
+def parse_migration_data(migration_data):
     # The processing of migration_data is meant to disrupt an attacker trying
     # to poison the redis instance. As such, the error message should not give
     # them any details as to what went wrong.
-    error_message = {"error": "Failed to start the migration."}
-
-    LOG.info(f"Migration requested")
-
-    migration_data = request.data
     if not migration_data:
-        LOG.debug(f"Migration failure: no migration data provided")
-        return jsonify(error_message), 400
+        LOG.debug("Migration failure: no migration data provided")
+        return None
 
     migration_data = migration_data.decode("utf-8")
     if not migration_data.strip().isprintable() or not migration_data.strip().isascii():
-        LOG.debug(f"Migration failure: migration data not all printable ASCII")
-        return jsonify(error_message), 400
+        LOG.debug("Migration failure: migration data not all printable ASCII")
+        return None
 
     try:
         migration_data_json = json.loads(migration_data)
     except Exception as exc:
-        LOG.debug(f"Migration failure: migration data is not valid JSON: {exc}")
-        return jsonify(error_message), 400
+        LOG.debug("Migration failure: migration data is not valid JSON: %s", exc)
+        return None
 
     try:
         validation_error = _validate_migration_data(migration_data_json)
     except Exception as exc:
-        LOG.debug(f"Migration failure: an exception occurred during validation: {exc}")
-        return jsonify(error_message), 400
+        LOG.debug("Migration failure: an exception occurred during validation: %s", exc)
+        return None
 
     if not validation_error:
-        return jsonify(error_message), 400
+        return None
+
+    return migration_data_json
+
+@game_app.route("/migrate/start", methods=["POST"])
+@csrf.exempt
+def start_migration():
+    LOG.info("Migration requested")
+
+    migration_data_json = parse_migration_data(request.data)
+    if migration_data_json is None:
+        return jsonify(MIGRATION_START_ERROR), 400
 
     redis_id = str(uuid.uuid4())
-    redis_key = f"{REDIS_KEY_PREFIX}-{redis_id}"
-    redis_conn.hmset(redis_key, migration_data_json)
-    redis_conn.expire(redis_key, 60)
+    redis_conn.hmset(migration_key(redis_id), migration_data_json)
+    redis_conn.expire(migration_key(redis_id), MIGRATION_TTL)
 
-    LOG.info(f"Migration initiated: {redis_id}")
+    LOG.info("Migration initiated: %s", redis_id)
 
     return jsonify({"id": redis_id}), 201
 
-@game_app.route("/migrate/complete")
-def complete_migration():
-    LOG.info(f"Migration continued")
-
-    id = request.args.get("id")
+def is_migration_id(id):
     if not id:
-        LOG.debug(f"Migration failure: no ID provided")
-        return redirect(url_for('.main'))
+        LOG.debug("Migration failure: no ID provided")
+        return False
 
     try:
         uuid.UUID(id)
     except:
-        LOG.debug(f"Migration failure: invalid ID provided; expected UUID")
-        return redirect(url_for('.main'))
+        LOG.debug("Migration failure: invalid ID provided; expected UUID")
+        return False
 
-    LOG.info(f"Migration continuing for {id}")
+    return True
 
-    migration_data = redis_conn.hgetall(f"{REDIS_KEY_PREFIX}-{id}")
+# Returns the migration data stored in redis, or None if it's not valid.
+def decode_migration_data(migration_data):
     if not migration_data:
-        LOG.debug(f"Migration failure: no data to load")
-        return redirect(url_for('.main'))
-
-    # Once we get the data, we no longer need it, regardless of validity.
-    redis_conn.delete(id)
+        LOG.debug("Migration failure: no data to load")
+        return None
 
     try:
         migration_data = {key.decode("ascii"): value.decode("ascii") for key, value in migration_data.items()}
     except UnicodeEncodeError as exc:
-        LOG.debug(f"Migration failure: loaded data not all ASCII: {exc}")
-        return redirect(url_for('.main'))
+        LOG.debug("Migration failure: loaded data not all ASCII: %s", exc)
+        return None
 
     if not _validate_migration_data(migration_data):
-        return redirect(url_for('.main'))
+        return None
 
-    LOG.debug(f"Migration continuing: storing data in session")
+    return migration_data
+
+def store_migration_data(migration_data):
+    LOG.debug("Migration continuing: storing data in session")
     session[SESSION_COOKIE_KEY] = json.dumps(migration_data)
 
+@game_app.route("/migrate/complete")
+def complete_migration():
+    LOG.info("Migration continued")
+
+    id = request.args.get("id")
+    if not is_migration_id(id):
+        return redirect(url_for('.main'))
+
+    LOG.info("Migration continuing for %s", id)
+
+    migration_data = redis_conn.hgetall(migration_key(id))
+    # Once we get the data, we no longer need it, regardless of validity.
+    redis_conn.delete(migration_key(id))
+
+    migration_data = decode_migration_data(migration_data)
+    if migration_data:
+        store_migration_data(migration_data)
+
     return redirect(url_for('.main'))
 
 def _validate_migration_data(migration_data):
     if not isinstance(migration_data, dict):
-        LOG.debug(f"Migration validation failure: migration_data is not a dict")
+        LOG.debug("Migration validation failure: migration_data is not a dict")
         return {"error": "Failed to load migration data."}
 
     game = get_game("1846")
@@ -105,40 +129,40 @@ def _validate_migration_data(migration_data):
     for key, value in migration_data.items():
         # Make sure no control characters or non-ASCII characters are present.
         if not key.isascii() or not key.isprintable() or not value.isascii() or not value.isprintable():
-            LOG.debug(f"Migration failure: key or value is not printable ASCII")
+            LOG.debug("Migration failure: key or value is not printable ASCII")
             return False
         
         try:
             migration_data[key] = json.dumps(json.loads(value))
         except Exception as exc:
-            LOG.debug(f"Migration validation failure[{key}]: value not valid JSON: {value}")
+            LOG.debug("Migration validation failure[%s]: value not valid JSON: %s", key, value)
             return False
 
         if key == "placedTilesTable":
             tiles_json = json.loads(value)
             if not all(len(row) == 3 for row in tiles_json) or not all(str(col).isalnum() for row in tiles_json for col in row):
-                LOG.debug(f"Migration validation failure[{key}]: {value}")
+                LOG.debug("Migration validation failure[%s]: %s", key, value)
                 return False
         elif key == "railroadsTable":
             railroads_json = json.loads(value)
             for row in railroads_json:
                 if len(row) not in (3, 4) or row[0].strip() not in railroad_info:
-                    LOG.debug(f"Migration validation failure[{key}]: row wrong length, or railroad name invalid: {value}")
+                    LOG.debug("Migration validation failure[%s]: row wrong length, or railroad name invalid: %s", key, value)
                     return False
                 if row[1] and row[1].strip():
                     train_strs = [train_str.strip().split("/", 1) for train_str in row[1].strip().split(",")]
                     if not all(val.strip().isdigit() for train_str in train_strs for val in train_str):
-                        LOG.debug(f"Migration validation failure[{key}]: trains malformed: {value}")
+                        LOG.debug("Migration validation failure[%s]: trains malformed: %s", key, value)
                         return False
                 if row[2] and row[2].strip():
                     if not all(station_str.strip().isalnum() for station_str in row[2].strip().split(",")):
-                        LOG.debug(f"Migration validation failure[{key}]: stations malformed: {value}")
+                        LOG.debug("Migration validation failure[%s]: stations malformed: %s", key, value)
                         return False
         elif key == "removedRailroadsTable":
             removed_railroads = json.loads(value)
             for railroad in removed_railroads:
                 if railroad.strip() not in railroad_info:
-                    LOG.debug(f"Migration validation failure[{key}]: railroad name invalid: {value}")
+                    LOG.debug("Migration validation failure[%s]: railroad name invalid: %s", key, value)
                     return False
         elif key == "privateCompaniesTable":
             private_companies_json = json.loads(value)
@@ -147,14 +171,14 @@ def _validate_migration_data(migration_data):
                         or row[0].strip() not in private_companies.COMPANIES \
                         or (row[1] and row[1].strip() not in railroad_info) \
                         or (row[2] and not row[2].strip().isalnum()):
-                    LOG.debug(f"Migration validation failure[{key}]: invalid row: {row}")
+                    LOG.debug("Migration validation failure[%s]: invalid row: %s", key, row)
                     return False
         elif key == "hideCityPaths":
             if value not in ("true", "false"):
-                LOG.debug(f"Migration validation failure[{key}]: {value}")
+                LOG.debug("Migration validation failure[%s]: %s", key, value)
                 return False
         else:
-            LOG.debug(f"Migration validation failure: invalid key: {key}")
+            LOG.debug("Migration validation failure: invalid key: %s", key)
             return False
 
     return True
@@ -195,12 +219,12 @@ def _convert_migration_data(migration_data):
 def process_migrate_data():
     migration_data = json.loads(session.pop(SESSION_COOKIE_KEY, "{}"))
     if migration_data:
-        LOG.debug(f"Migration finalizing: found session data.")
+        LOG.debug("Migration finalizing: found session data.")
         if _validate_migration_data(migration_data):
-            LOG.debug(f"Migration data pre-conversion: {migration_data}")
+            LOG.debug("Migration data pre-conversion: %s", migration_data)
             migration_data = _convert_migration_data(migration_data)
-            LOG.debug(f"Migration data post-conversion: {migration_data}")
+            LOG.debug("Migration data post-conversion: %s", migration_data)
         else:
-            LOG.debug(f"Migration validation failed: continuing without migration")
+            LOG.debug("Migration validation failed: continuing without migration")
             migration_data = {}
     return migration_data
@@ -0,0 +1,48 @@
+import hmac
+import os
+import time
+
+from flask import Response, abort, g, request
+from rq import Queue, Worker
+
+from routes18xxweb import metrics
+from routes18xxweb.calculator import listen, redis_conn
+from routes18xxweb.routes18xxweb import app, csrf
+
+# If set, scrapers have to send it as a bearer token.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if "request_start_time" in g:
+        labels = {"endpoint": request.endpoint or "none", "method": request.method, "status": response.status_code}
+        metrics.observe("http-request-duration-seconds", time.perf_counter() - g.request_start_time, labels)
+    metrics.flush_cache_stats()
+    return response
+
+# Queue lengths and worker states are read when scraped, rather than recorded.
+def _get_gauges():
+    queue_lengths = {f'queue="{name}"': Queue(name, connection=redis_conn).count for name in listen}
+
+    worker_counts = {"busy": 0, "idle": 0}
+    for worker in Worker.all(connection=redis_conn):
+        worker_counts["busy" if worker.get_state() == "busy" else "idle"] += 1
+
+    return {
+        "rq-queue-length": queue_lengths,
+        "rq-workers": {f'state="{state}"': count for state, count in worker_counts.items()}
+    }
+
+@app.route("/metrics")
+@csrf.exempt
+def get_metrics():
+    if METRICS_TOKEN:
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(token, METRICS_TOKEN):
+            abort(403)
+
+    return Response(metrics.render(_get_gauges()), mimetype="text/plain; version=0.0.4")
@@ -1,13 +1,19 @@
-import base64
 import json
 import os
 
 from flask import request
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Attachment
+from rq import Retry
 
+from routes18xxweb import mail, profiling
 from routes18xxweb.routes18xxweb import app, game_app
-from routes18xxweb.views import calculate
+from routes18xxweb.views import LOG, calculate
+
+# Reports are mailed by a worker, retrying with a growing wait between tries
+# (REPORT_RETRY_INTERVAL seconds, then 4 times that, and so on) if the mail
+# backend fails.
+REPORT_RETRIES = int(os.getenv("REPORT_RETRIES", 3))
+REPORT_RETRY_INTERVAL = int(os.getenv("REPORT_RETRY_INTERVAL", 15))
+REPORT_JOB_TIMEOUT = 60
 
 MESSAGE_BODY_FORMAT = "User: {user}\nComments:\n{comments}\nPhase: {phase}"
 TILE_MESSAGE_BODY_FORMAT = MESSAGE_BODY_FORMAT + "\nSelected:\n\tcoordinate: {coord}\n\ttile: {tile_id}\n\torientation: {orientation}"
@@ -17,13 +23,16 @@ def _attach_json(msg, filename, content=None):
         with open(filename) as json_file:
             content = json_file.read()
 
-    encoded_content = base64.b64encode(json.dumps(content, indent=4, sort_keys=True).encode("utf-8")).decode()
-    msg.add_attachment(
-        Attachment(file_content=encoded_content, file_type="application/json", file_name=os.path.basename(filename))
-    )
+    mail.attach(msg, filename, json.dumps(content, indent=4, sort_keys=True).encode("utf-8"), "application/json")
 
-def _sendgrid_client():
-    return SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+# Queues the report to be mailed, so a slow mail API doesn't hold up the
+# request. The client only hears that it's been accepted.
+def _send_report(msg):
+    retry_intervals = [REPORT_RETRY_INTERVAL * 4 ** attempt for attempt in range(REPORT_RETRIES)]
+    retry = Retry(max=REPORT_RETRIES, interval=retry_intervals) if REPORT_RETRIES else None
+    job = calculate.CALCULATOR_QUEUES["low"].enqueue(mail.send, msg, job_timeout=REPORT_JOB_TIMEOUT, result_ttl=0, retry=retry)
+    LOG.info("Queued report \"%s\" as job %s", msg["subject"], job.id)
+    return "", 202
 
 def _build_general_message():
     railroad_headers = json.loads(request.form.get("railroadHeaders"))
@@ -41,11 +50,8 @@ def _build_general_message():
     private_companies_json = [dict(zip(private_companies_headers, row)) for row in private_companies_data]
     placed_tiles_json = [dict(zip(placed_tiles_headers, row)) for row in placed_tiles_data if any(row)]
 
-    msg = Mail(
-        from_email=app.config.get("MAIL_USERNAME"),
-        to_emails=os.environ["BUG_REPORT_EMAIL"],
-        subject=email_subject,
-        plain_text_content=MESSAGE_BODY_FORMAT.format(user=user_email, comments=user_comments, phase=phase))
+    msg = mail.create_message(app.config.get("MAIL_USERNAME"), os.environ["BUG_REPORT_EMAIL"], email_subject,
+            MESSAGE_BODY_FORMAT.format(user=user_email, comments=user_comments, phase=phase))
 
     _attach_json(msg, "railroads.json", railroads_json)
     _attach_json(msg, "private-companies.json", private_companies_json)
@@ -55,8 +61,7 @@ def _build_general_message():
 
 @game_app.route("/report/general-issue", methods=["POST"])
 def report_general_issue():
-    response = _sendgrid_client().send(_build_general_message())
-    return ""
+    return _send_report(_build_general_message())
 
 @game_app.route("/report/calc-issue", methods=["POST"])
 def report_calc_issue():
@@ -76,9 +81,13 @@ def report_calc_issue():
 
     _attach_json(msg, "routes.json", {target_railroad: routes_json})
 
-    response = _sendgrid_client().send(msg)
+    # The calculation was profiled if it was sampled or an admin asked.
+    profile_stats = profiling.get_stats(job_id)
+    if profile_stats is not None:
+        mail.attach(msg, "profile.txt", profiling.get_summary(job_id).encode("utf-8"), "text/plain")
+        mail.attach(msg, "profile.prof", profile_stats, "application/octet-stream")
 
-    return ""
+    return _send_report(msg)
 
 @game_app.route("/report/tile-issue", methods=["POST"])
 def report_tile_issue():
@@ -99,11 +108,7 @@ def report_tile_issue():
     message_body = TILE_MESSAGE_BODY_FORMAT.format(
         user=user_email, comments=user_comments, phase=phase, coord=coord, tile_id=tile_id, orientation=orientation)
 
-    msg = Mail(
-        from_email=app.config.get("MAIL_USERNAME"),
-        to_emails=os.environ["BUG_REPORT_EMAIL"],
-        subject=email_subject,
-        plain_text_content=message_body)
+    msg = mail.create_message(app.config.get("MAIL_USERNAME"), os.environ["BUG_REPORT_EMAIL"], email_subject, message_body)
 
     placed_tiles_json = [dict(zip(placed_tiles_headers, row)) for row in placed_tiles_data if any(row)]
 
@@ -113,6 +118,4 @@ def report_tile_issue():
     _attach_json(msg, "stations.json", dict(stations))
     _attach_json(msg, "private-companies.json", dict(private_companies))
 
-    response = _sendgrid_client().send(msg)
-
-    return ""
+    return _send_report(msg)